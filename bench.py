@@ -0,0 +1,752 @@
+#! /usr/bin/env python
+# benchmarks for the parsing and tree hot paths, run over synthetic trees,
+# rules and s-expressions so that results are reproducible from a seed
+# usage:
+#   bench.py -n 2000 --save before.json
+#   ... change things ...
+#   bench.py -n 2000 --compare before.json
+# each group of benchmarks runs in a child process so that its peak memory
+# can be reported; --compare exits with status 1 if anything got slower by
+# more than --threshold
+import argparse
+import sys
+import os
+import gc
+import re
+import json
+import random
+import time
+import cPickle
+import resource
+from string import whitespace
+import jmutil
+import pstree
+import tree
+import head_finder
+import treecorpus
+import sbmt
+import sexp
+
+PHRASES = ['S', 'NP', 'VP', 'PP', 'SBAR', 'ADJP', 'ADVP', 'QP', 'WHNP', 'PRN']
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+TAGS = ['NN', 'NNS', 'NNP', 'DT', 'JJ', 'IN', 'VBD', 'VBZ', 'RB', 'CD', 'PRP', 'CC', ',', '.']
+
+_token = re.compile(r"\(|\)|[^()\s]+")
+
+def synthetic_vocab(rng, size=5000):
+  '''Return size random lower-case words of 1 to 10 letters.'''
+  return [''.join(rng.choice(LETTERS) for i in xrange(rng.randint(1, 10))) for j in xrange(size)]
+
+def synthetic_tree(rng, vocab, length=25, depth=8, branching=3):
+  '''Return the text of a random Penn-style tree over length words drawn from
+  vocab.  Phrases have up to branching children and nesting stops at depth,
+  below which the remaining words are attached as a flat list of
+  preterminals.'''
+  out = ['(ROOT']
+  stack = [(length, 0)]
+  while len(stack) > 0:
+    item = stack.pop()
+    if item is None:
+      out.append(')')
+      continue
+    (words, level) = item
+    if words == 1:
+      out.append(' (%s %s)' % (rng.choice(TAGS), rng.choice(vocab)))
+      continue
+    out.append(' (' + rng.choice(PHRASES))
+    stack.append(None)
+    if level >= depth:
+      parts = [1] * words
+    else:
+      cuts = sorted(rng.sample(xrange(1, words), min(branching, words) - 1))
+      parts = [b - a for (a, b) in zip([0] + cuts, cuts + [words])]
+    for part in reversed(parts):
+      stack.append((part, level + 1))
+  out.append(')')
+  return ''.join(out)
+
+def synthetic_corpus(sentences=1000, length=25, depth=8, branching=3, seed=0):
+  '''Return a list of synthetic tree strings; the same arguments always give
+  the same corpus.'''
+  rng = random.Random(seed)
+  vocab = synthetic_vocab(rng)
+  return [synthetic_tree(rng, vocab, length, depth, branching) for i in xrange(sentences)]
+
+def synthetic_rule(rng, vocab, index=0, depth=2):
+  '''Return the text of a random ISI-style rule,
+    TARGET -> SOURCE ### features
+  whose TARGET is an a(b c) tree of phrases, quoted preterminals and
+  variables xN:LABEL, with a matching headmarker feature.'''
+  target = []
+  heads = []
+  words = []
+  variables = 0
+  stack = [('R', rng.choice(PHRASES), depth)]
+  while len(stack) > 0:
+    item = stack.pop()
+    if item is None:
+      target.append(')')
+      heads.append(')')
+      continue
+    if len(target) > 0 and not target[-1].endswith('('):
+      target.append(' ')
+    (head, label, level) = item
+    if label is None:
+      # a leaf: a variable or a quoted word under a tag
+      heads.append(head)
+      if rng.random() < 0.5:
+        target.append('x%d:%s' % (variables, rng.choice(PHRASES + TAGS)))
+        variables += 1
+      else:
+        word = '"%s"' % (rng.choice(vocab) if rng.random() < 0.97 else rng.choice('()'))
+        target.append('%s(%s)' % (rng.choice(TAGS), word))
+        words.append(word)
+      continue
+    target.append(label + '(')
+    heads.append(head + '(')
+    stack.append(None)
+    children = rng.randint(1, 3)
+    chosen = rng.randrange(children)
+    for i in reversed(xrange(children)):
+      head = 'H' if i == chosen else 'D'
+      if level > 0 and rng.random() < 0.3:
+        stack.append((head, rng.choice(PHRASES), level - 1))
+      else:
+        stack.append((head, None, level - 1))
+  source = ['x%d' % i for i in xrange(variables)] + words + ['"%s"' % rng.choice(vocab) for i in xrange(rng.randint(0, 2))]
+  rng.shuffle(source)
+  feats = ['id=%d' % index, 'count=%d' % rng.randint(1, 1000),
+           'lm=%.4f' % -rng.expovariate(0.2), 'tm=%.4f' % -rng.expovariate(0.5),
+           'headmarker={{{%s}}}' % ''.join(heads),
+           'align={{{[#s=%d #t=%d 0,0]}}}' % (len(source), variables + len(words))]
+  rng.shuffle(feats)
+  return '%s -> %s ### %s' % (''.join(target), ' '.join(source), ' '.join(feats))
+
+def synthetic_rules(rules=1000, seed=0):
+  '''Return a list of synthetic rule strings; the same arguments always give
+  the same rules.'''
+  rng = random.Random(seed)
+  vocab = synthetic_vocab(rng)
+  return [synthetic_rule(rng, vocab, i) for i in xrange(rules)]
+
+def synthetic_nbest(sentences=100, hypotheses=100, seed=0):
+  '''Return the lines of a synthetic ISI-style n-best list with the given
+  number of hypotheses for each sentence.'''
+  rng = random.Random(seed)
+  vocab = synthetic_vocab(rng)
+  features = ['lm', 'tm', 'count', 'derivation-size', 'unk', 'glue', 'text-length'] + ['f%d' % i for i in xrange(20)]
+  lines = []
+  for sent in xrange(sentences):
+    for rank in xrange(hypotheses):
+      words = [rng.choice(vocab) for i in xrange(rng.randint(5, 30))]
+      feats = ['%s=%.4f' % (name, -rng.expovariate(0.3)) for name in features if rng.random() < 0.8]
+      lines.append('NBEST sent=%d nbest=%d totalcost=%.4f hyp={{{%s}}} %s derivation={{{%s}}}' %
+                   (sent, rank, rng.expovariate(0.1), ' '.join(words), ' '.join(feats), ' '.join(words[:3])))
+  return lines
+
+def synthetic_sexp(rng, vocab, depth=4, width=4):
+  '''Return the text of a random s-expression of symbols, integers, floats,
+  strings with escapes and quoted forms.'''
+  out = []
+  stack = [depth]
+  while len(stack) > 0:
+    level = stack.pop()
+    if level is None:
+      out.append(')')
+      continue
+    r = rng.random()
+    if level > 0 and (level == depth or r < 0.3):
+      out.append(" '(" if r < 0.05 else ' (')
+      stack.append(None)
+      stack.extend([level - 1] * rng.randint(1, width))
+    elif r < 0.5:
+      out.append(' ' + rng.choice(vocab))
+    elif r < 0.6:
+      out.append(" '" + rng.choice(vocab))
+    elif r < 0.75:
+      out.append(' %d' % rng.randint(0, 100000))
+    elif r < 0.85:
+      out.append(' %.3f' % rng.uniform(0, 100))
+    else:
+      out.append(' "%s \\"%s\\""' % (rng.choice(vocab), rng.choice(vocab)))
+  return ''.join(out).strip()
+
+def synthetic_sexps(count=1000, seed=0):
+  rng = random.Random(seed)
+  vocab = synthetic_vocab(rng)
+  return [synthetic_sexp(rng, vocab) for i in xrange(count)]
+
+def legacy_tree_from_text(text, allow_empty_labels=False, allow_empty_words=False, allow_weights=True):
+  '''The original character-at-a-time pstree.tree_from_text, kept as the
+  baseline for bench_tree_from_text.'''
+  root = None
+  cur = None
+  pos = 0
+  word = ''
+  for char in text:
+    if cur is None:
+      if char == '(':
+        root = pstree.PSTree()
+        cur = root
+      continue
+    if char == '(':
+      word = word.strip()
+      if cur.label is pstree.DEFAULT_LABEL:
+        if len(word) == 0 and not allow_empty_labels:
+          raise Exception("Empty label found\n%s" % text)
+        cur.label = word
+        word = ''
+      if word != '' and not (allow_weights and jmutil.isFloat(word)):
+        raise Exception("Stray '%s' while processing\n%s" % (word, text))
+      sub = pstree.PSTree()
+      cur.subtrees.append(sub)
+      sub.parent = cur
+      cur = sub
+    elif char == ')':
+      word = word.strip()
+      if word != '':
+        cur.word = word
+        word = ''
+        cur.span = (pos, pos + 1)
+        pos += 1
+      else:
+        cur.span = (cur.subtrees[0].span[0], cur.subtrees[-1].span[1])
+      cur = cur.parent
+    elif char == ' ':
+      if cur.label is pstree.DEFAULT_LABEL:
+        if len(word) == 0 and not allow_empty_labels:
+          raise Exception("Empty label found\n%s" % text)
+        cur.label = word
+        word = ''
+      else:
+        word += char
+    else:
+      word += char
+  if cur is not None:
+    raise Exception("Text did not include complete tree\n%s" % text)
+  return root
+
+def legacy_scan_tree(tokens, pos):
+  '''The original recursive tree.scan_tree, kept as the baseline for
+  bench_str_to_tree.'''
+  try:
+    if tokens[pos] == "(":
+      if tokens[pos+1] == "(":
+        label = ""
+        pos += 1
+      else:
+        label = tokens[pos+1]
+        pos += 2
+      children = []
+      (child, pos) = legacy_scan_tree(tokens, pos)
+      while child != None:
+        children.append(child)
+        (child, pos) = legacy_scan_tree(tokens, pos)
+      if tokens[pos] == ")":
+        return (tree.Node(label, children), pos+1)
+      else:
+        return (None, pos)
+    elif tokens[pos] == ")":
+      return (None, pos)
+    else:
+      return (tree.Node(tokens[pos], []), pos+1)
+  except IndexError:
+    return (None, pos)
+
+def legacy_str_to_tree(s):
+  tokens = tree.tokenizer.findall(s)
+  (node, n) = legacy_scan_tree(tokens, 0)
+  if n != len(tokens):
+    return None
+  return node
+
+def legacy_pstree_repr(self):
+  '''The original recursive PSTree.__repr__, kept as the baseline for
+  bench_write.'''
+  ans = '('
+  if self.is_trace():
+    ans += pstree.TRACE_LABEL + ' ' + self.word
+  elif self.is_terminal():
+    ans += self.label + ' ' + self.word
+  else:
+    ans += self.label
+  for subtree in self.subtrees:
+    ans += ' ' + legacy_pstree_repr(subtree)
+  ans += ')'
+  return ans
+
+def legacy_node_str(self):
+  '''The original recursive tree.Node.__str__.'''
+  if len(self.children) != 0:
+    s = "(" + str(self.label)
+    for child in self.children:
+      s += " " + legacy_node_str(child)
+    s += ")"
+    return s
+  else:
+    return self.label
+
+def legacy_parse_feat_string(string):
+  '''The original sbmt.parse_feat_string, which compiled its pattern on
+  every call, kept as the baseline for bench_rules.'''
+  feats = {}
+  entryre = re.compile(r"\s*(\S+)=((?:[^\s{}]+)|(?:{{{[^\}]*}}}))\s*")
+  for match in entryre.findall(string):
+    feats[match[0]] = match[1]
+  return feats
+
+NBEST_WEIGHTS = {'lm': 1.0, 'tm': 0.5, 'count': 0.1, 'f3': -0.2}
+
+def legacy_nbest_scores(lines):
+  '''Score a list of n-best lines with NBEST_WEIGHTS through
+  sbmt.parse_nbest, converting every value that is a number to a float.'''
+  scores = []
+  for line in lines:
+    feats = sbmt.parse_nbest(line)
+    for (name, value) in feats.items():
+      if jmutil.isFloat(value):
+        feats[name] = float(value)
+    scores.append(sum(weight * feats.get(name, 0.0) for (name, weight) in NBEST_WEIGHTS.items()))
+  return scores
+
+def nbest_scores(lines):
+  '''The same scores through sbmt.read_nbest.'''
+  return [nbest.scores(NBEST_WEIGHTS) for nbest in sbmt.read_nbest(lines)]
+
+def legacy_parse_rule(string):
+  (rule, rest) = string.split(" ### ")
+  feats = legacy_parse_feat_string(rest)
+  (target, source) = rule.split(" -> ")
+  feats['SOURCE'] = source
+  feats['TARGET'] = target
+  return feats
+
+def legacy_parse_rule_tree(string):
+  '''sbmt.parse_rule_tree as it was, rewriting the a(b c) notation as a
+  bracketed tree for tree.str_to_tree.'''
+  string = re.sub(r'"\("', r'"-LRBJM-"', string)
+  string = re.sub(r'"\)"', r'"-RRBJM-"', string)
+  string = re.sub('\(', r' ( ', string).split(' ')
+  for idx, tok in enumerate(string):
+    if tok == "(":
+      string[idx-1], string[idx] = string[idx], string[idx-1]
+  ptree = tree.str_to_tree(' '.join(string))
+  for node in ptree.frontier():
+    if node.label == '"-LRBJM-"':
+      node.label = '"("'
+    if node.label == '"-RRBJM-"':
+      node.label = '")"'
+  return ptree
+
+def legacy_head_annotate(rule, local=True):
+  '''sbmt.head_annotate_tree_from_rule as it was, parsing the headmarker
+  into a second tree.'''
+  target = legacy_parse_rule_tree(rule['TARGET'].strip())
+  head_tree_text = ' '.join(list(rule['headmarker'].strip('{}').strip()))
+  head_tree_text = re.sub(r' +\(', r'(', head_tree_text)
+  heads = legacy_parse_rule_tree(head_tree_text)
+  return sbmt.head_annotate_tree(heads, target, relative=None if local else target)
+
+def legacy_rule_variables(string):
+  '''The source order and target labels of a rule's variables through
+  sbmt.target_order_map and sbmt.get_var_label, a regex per token.'''
+  feats = sbmt.parse_rule(string)
+  order = sbmt.target_order_map(feats['SOURCE'])
+  labels = {}
+  for tok in re.split(r'[\s()]+', feats['TARGET']):
+    pos = sbmt.get_var_position(tok)
+    if pos is not None:
+      labels[pos] = sbmt.get_var_label(tok)
+  return ([order[i] for i in xrange(len(order))], [labels[i] for i in xrange(len(labels))])
+
+def legacy_sexp_parse(sexp):
+  '''sexp.parse as it was, a character at a time, with eval for numbers.'''
+  stack, i, length = [[]], 0, len(sexp)
+  while i < length:
+    c = sexp[i]
+    reading = type(stack[-1])
+    if reading == list:
+      if c == '(': stack.append([])
+      elif c == ')':
+        stack[-2].append(stack.pop())
+        if stack[-1][0] == ('quote',): stack[-2].append(stack.pop())
+      elif c == '"': stack.append('')
+      elif c == "'": stack.append([('quote',)])
+      elif c in whitespace: pass
+      else: stack.append((c,))
+    elif reading == str:
+      if c == '"':
+        stack[-2].append(stack.pop())
+        if stack[-1][0] == ('quote',): stack[-2].append(stack.pop())
+      elif c == '\\':
+        i += 1
+        stack[-1] += sexp[i]
+      else: stack[-1] += c
+    elif reading == tuple:
+      if c in legacy_atom_end:
+        atom = stack.pop()
+        if atom[0][0].isdigit(): stack[-1].append(eval(atom[0]))
+        else: stack[-1].append(atom)
+        if stack[-1][0] == ('quote',): stack[-2].append(stack.pop())
+        continue
+      else: stack[-1] = ((stack[-1][0] + c),)
+    i += 1
+  return stack.pop()
+
+legacy_atom_end = set('()"\'') | set(whitespace)
+
+def rule_sides(string):
+  '''What a filter over a grammar often needs: just the sides, through
+  sbmt.Rule.'''
+  rule = sbmt.Rule.from_string(string)
+  return (rule.target, rule.source)
+
+def rule_score(string):
+  '''The sides and one score, through sbmt.Rule.'''
+  rule = sbmt.Rule.from_string(string)
+  return (rule.target, rule.source, rule.feature('lm'))
+
+# a small sweep over weights, as when tuning
+RULE_WEIGHTS = [{'lm': 1.0, 'tm': 0.1 * i, 'count': 0.01} for i in xrange(5)]
+
+def legacy_rule_scores(rules):
+  '''Scores of a list of rules under each of RULE_WEIGHTS through
+  sbmt.parse_rule.'''
+  feats = [sbmt.parse_rule(string) for string in rules]
+  return [[sum(weight * float(f.get(name, 0)) for (name, weight) in weights.items()) for f in feats]
+          for weights in RULE_WEIGHTS]
+
+def rule_feature_scores(rules):
+  '''The same scores through sbmt.rule_features.'''
+  batch = sbmt.rule_features(rules)
+  return [batch.dot(weights) for weights in RULE_WEIGHTS]
+
+def timeit(func, items, repeat=5):
+  '''Return the best wall-clock time in seconds of calling func on every
+  item, over repeat runs.  As in the timeit module, the cyclic garbage
+  collector is switched off while the clock is running.'''
+  best = None
+  for i in xrange(repeat):
+    gc.collect()
+    gc.disable()
+    try:
+      t1 = time.time()
+      for item in items:
+        func(item)
+      t2 = time.time()
+    finally:
+      gc.enable()
+    if best is None or t2 - t1 < best:
+      best = t2 - t1
+  return best
+
+def compare(funcs, items, repeat=5):
+  '''Time each (name, func) pair over items, interleaving the runs so that
+  noise on a busy machine hits every function alike.  Returns a list of
+  (name, best seconds).'''
+  best = [None] * len(funcs)
+  for i in xrange(repeat):
+    for (j, (name, func)) in enumerate(funcs):
+      secs = timeit(func, items, 1)
+      if best[j] is None or secs < best[j]:
+        best[j] = secs
+  return [(name, secs) for ((name, func), secs) in zip(funcs, best)]
+
+def _rows(results, counts):
+  '''Rows for the results of one compare, each later function noting the
+  first as its baseline.'''
+  baseline = results[0][0] if len(results) > 1 else None
+  return [(name, secs, counts, baseline if name != baseline else None) for (name, secs) in results]
+
+def bench_tree_from_text(corpus, repeat=5, seed=0):
+  '''Compare pstree.tree_from_text against the character-level baseline.
+  Returns a list of (name, seconds, [(count, unit), ...], baseline name or
+  None) rows, as do all the bench_ functions.  Those that make their own
+  synthetic data beside the corpus make it from seed.'''
+  tokens = sum(len(_token.findall(text)) for text in corpus)
+  funcs = [('legacy_tree_from_text', legacy_tree_from_text),
+           ('pstree.tree_from_text', pstree.tree_from_text)]
+  return _rows(compare(funcs, corpus, repeat), [(len(corpus), 'trees'), (tokens, 'tokens')])
+
+def bench_str_to_tree(corpus, repeat=5, seed=0):
+  '''Compare tree.str_to_tree against the recursive baseline.'''
+  tokens = sum(len(_token.findall(text)) for text in corpus)
+  funcs = [('legacy_str_to_tree', legacy_str_to_tree),
+           ('tree.str_to_tree', tree.str_to_tree)]
+  return _rows(compare(funcs, corpus, repeat), [(len(corpus), 'trees'), (tokens, 'tokens')])
+
+def bench_write(corpus, repeat=5, seed=0):
+  '''Compare writing PSTrees and tree.Nodes as text against the recursive
+  baselines.'''
+  tokens = sum(len(_token.findall(text)) for text in corpus)
+  counts = [(len(corpus), 'trees'), (tokens, 'tokens')]
+  pstrees = [pstree.tree_from_text(text) for text in corpus]
+  nodes = [tree.str_to_tree(text) for text in corpus]
+  return (_rows(compare([('legacy_pstree_repr', legacy_pstree_repr), ('PSTree.__repr__', repr)], pstrees, repeat), counts) +
+          _rows(compare([('legacy_node_str', legacy_node_str), ('Node.__str__', str)], nodes, repeat), counts))
+
+def bench_heads(corpus, repeat=5, seed=0):
+  '''head_finder.collins_find_heads over every tree, and
+  TreeCorpus.find_heads over all of them at once.'''
+  trees = [pstree.tree_from_text(text) for text in corpus]
+  nodes = sum(1 for root in trees for node in root)
+  funcs = [('head_finder.collins_find_heads', head_finder.collins_find_heads)]
+  columns = treecorpus.TreeCorpus.from_pstrees(trees)
+  return (_rows(compare(funcs, trees, repeat), [(len(trees), 'trees'), (nodes, 'nodes')]) +
+          _rows(compare([('TreeCorpus.find_heads', treecorpus.TreeCorpus.find_heads)], [columns], repeat), [(len(trees), 'trees'), (nodes, 'nodes')]))
+
+def bench_rules(corpus, repeat=5, seed=0):
+  '''sbmt.parse_rule, sbmt.Rule, sbmt.parse_feat_string and weighted
+  scoring with sbmt.rule_features against the original parser, over one
+  synthetic rule per tree.'''
+  rules = synthetic_rules(len(corpus), seed)
+  feats = [rule.split(' ### ')[1] for rule in rules]
+  funcs = [('legacy_parse_rule', legacy_parse_rule),
+           ('sbmt.parse_rule', sbmt.parse_rule),
+           ('sbmt.Rule (sides)', rule_sides),
+           ('sbmt.Rule (sides + lm)', rule_score)]
+  blocks = [rules[i:i + 1000] for i in xrange(0, len(rules), 1000)]
+  return (_rows(compare(funcs, rules, repeat), [(len(rules), 'rules')]) +
+          _rows(compare([('legacy_parse_feat_string', legacy_parse_feat_string),
+                         ('sbmt.parse_feat_string', sbmt.parse_feat_string)], feats, repeat), [(len(feats), 'rules')]) +
+          _rows(compare([('legacy_rule_scores', legacy_rule_scores),
+                         ('sbmt.rule_features (dot)', rule_feature_scores)], blocks, repeat), [(len(rules), 'rules')]))
+
+def bench_sexp(corpus, repeat=5, seed=0):
+  '''sexp.parse against the original character-level parser, over one
+  synthetic s-expression per tree.'''
+  texts = synthetic_sexps(len(corpus), seed)
+  chars = sum(len(text) for text in texts)
+  funcs = [('legacy_sexp_parse', legacy_sexp_parse),
+           ('sexp.parse', sexp.parse)]
+  return _rows(compare(funcs, texts, repeat), [(len(texts), 'sexps'), (chars, 'chars')])
+
+def bench_rule_tree(corpus, repeat=5, seed=0):
+  '''sbmt.parse_rule_tree against the original rewrite through
+  tree.str_to_tree, over the targets of one synthetic rule per tree.'''
+  targets = [rule.split(' -> ')[0] for rule in synthetic_rules(len(corpus), seed)]
+  funcs = [('legacy_parse_rule_tree', legacy_parse_rule_tree),
+           ('sbmt.parse_rule_tree', sbmt.parse_rule_tree)]
+  return _rows(compare(funcs, targets, repeat), [(len(targets), 'rules')])
+
+def bench_rule_heads(corpus, repeat=5, seed=0):
+  '''Head annotation of one synthetic rule per tree: the original two-tree
+  annotation, sbmt.head_annotate_tree_from_rule, and the head flags alone
+  from sbmt.rule_head_flags.'''
+  rules = [sbmt.Rule.from_string(rule) for rule in synthetic_rules(len(corpus), seed)]
+  funcs = [('legacy_head_annotate', legacy_head_annotate),
+           ('sbmt.head_annotate_tree_from_rule', sbmt.head_annotate_tree_from_rule),
+           ('sbmt.rule_head_flags', sbmt.rule_head_flags)]
+  return _rows(compare(funcs, rules, repeat), [(len(rules), 'rules')])
+
+def bench_variables(corpus, repeat=5, seed=0):
+  '''Variable extraction from one synthetic rule per tree: the per-token
+  regexes against sbmt.rule_variables, and sbmt.variable_alignments with
+  crossing counts over blocks of 1000 rules.'''
+  rules = synthetic_rules(len(corpus), seed)
+  blocks = [rules[i:i + 1000] for i in xrange(0, len(rules), 1000)]
+  return (_rows(compare([('legacy_rule_variables', legacy_rule_variables),
+                         ('sbmt.rule_variables', sbmt.rule_variables)], rules, repeat), [(len(rules), 'rules')]) +
+          _rows(compare([('sbmt.variable_alignments (crossings)', lambda block: sbmt.variable_alignments(block).crossings())],
+                        blocks, repeat), [(len(rules), 'rules')]))
+
+def bench_nbest(corpus, repeat=5, seed=0):
+  '''Reading and scoring an n-best list with sbmt.read_nbest against
+  sbmt.parse_nbest, over 100 hypotheses for every 10 trees, in blocks of 10
+  sentences.'''
+  lines = synthetic_nbest(max(1, len(corpus) / 10), seed=seed)
+  blocks = [lines[i:i + 1000] for i in xrange(0, len(lines), 1000)]
+  funcs = [('legacy_nbest_scores', legacy_nbest_scores),
+           ('sbmt.read_nbest', nbest_scores)]
+  return _rows(compare(funcs, blocks, repeat), [(len(lines), 'hyps')])
+
+def bench_ngram(corpus, repeat=5, seed=0):
+  '''jmutil.ngram with n=3 over the words of every tree.'''
+  sentences = [pstree.tree_from_text(text).word_yield(as_list=True) for text in corpus]
+  words = sum(len(words) for words in sentences)
+  return _rows(compare([('jmutil.ngram', lambda words: jmutil.ngram(words, 3))], sentences, repeat), [(words, 'words')])
+
+BENCHMARKS = [('tree_from_text', bench_tree_from_text),
+              ('str_to_tree', bench_str_to_tree),
+              ('write', bench_write),
+              ('heads', bench_heads),
+              ('rules', bench_rules),
+              ('rule_tree', bench_rule_tree),
+              ('rule_heads', bench_rule_heads),
+              ('variables', bench_variables),
+              ('nbest', bench_nbest),
+              ('sexp', bench_sexp),
+              ('ngram', bench_ngram)]
+
+def peak_kb():
+  '''Peak resident memory of this process in KB (ru_maxrss is in bytes on
+  OS X).'''
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / 1024 if sys.platform == 'darwin' else peak
+
+def isolated(func, *args):
+  '''Call func(*args) in a forked child and return (result, KB of memory the
+  call added to the child's peak), so that benchmarks neither see each
+  other's garbage nor inflate each other's peak.  Without fork the call is
+  made here and the memory is None.'''
+  if not hasattr(os, 'fork'):
+    return (func(*args), None)
+  (rfd, wfd) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(rfd)
+    try:
+      base = peak_kb()
+      out = cPickle.dumps((func(*args), peak_kb() - base), -1)
+      status = 0
+    except BaseException, e:
+      out = cPickle.dumps(Exception("%s: %s" % (type(e).__name__, e)), -1)
+      status = 1
+    with os.fdopen(wfd, 'wb') as fh:
+      fh.write(out)
+    os._exit(status)
+  os.close(wfd)
+  with os.fdopen(rfd, 'rb') as fh:
+    data = fh.read()
+  os.waitpid(pid, 0)
+  result = cPickle.loads(data)
+  if isinstance(result, Exception):
+    raise result
+  return result
+
+def node_bytes(roots):
+  '''Return (bytes, nodes) for the trees under roots: the size of every node
+  object, its attribute dict if it has one, and every string, tuple and list
+  it refers to, each shared object counted once.'''
+  seen = set()
+  total = 0
+  nodes = 0
+  stack = list(roots)
+  while len(stack) > 0:
+    obj = stack.pop()
+    if obj is None or id(obj) in seen:
+      continue
+    seen.add(id(obj))
+    total += sys.getsizeof(obj)
+    if isinstance(obj, (pstree.PSTree, tree.Node)):
+      nodes += 1
+      attrs = getattr(obj, '__dict__', None)
+      if attrs is not None:
+        total += sys.getsizeof(attrs)
+        stack.extend(attrs.values())
+      for name in getattr(type(obj), '__slots__', ()):
+        stack.append(getattr(obj, name, None))
+    elif isinstance(obj, (list, tuple)):
+      stack.extend(obj)
+  return (total, nodes)
+
+def bench_memory(corpus):
+  '''Bytes per node of the trees built by pstree.tree_from_text and
+  tree.str_to_tree.  Returns a list of (name, bytes, nodes).'''
+  results = []
+  for (name, func) in (('pstree.tree_from_text', pstree.tree_from_text),
+                       ('tree.str_to_tree', tree.str_to_tree)):
+    roots = [func(text) for text in corpus]
+    results.append((name,) + node_bytes(roots))
+  return results
+
+def run(corpus, names=None, repeat=5, seed=0):
+  '''Run the named benchmark groups (all of them by default), each in its
+  own process, with seed for the data they make themselves.  Returns a dict in the form written by --save:
+    {'results': {name: {'secs': s, 'rates': {unit: per sec}}},
+     'memory': {group: peak KB}, 'order': [names]}'''
+  report = {'results': {}, 'memory': {}, 'order': []}
+  for (group, func) in BENCHMARKS:
+    if names is not None and group not in names:
+      continue
+    (rows, kb) = isolated(func, corpus, repeat, seed)
+    report['memory'][group] = kb
+    for (name, secs, counts, baseline) in rows:
+      report['order'].append(name)
+      report['results'][name] = {'secs': secs, 'group': group, 'baseline': baseline,
+                                 'rates': dict((unit, count / secs) for (count, unit) in counts)}
+  return report
+
+def compare_reports(old, new, threshold=0.1):
+  '''Compare two reports from run, benchmark by benchmark.  Returns a list of
+  (name, old rate, new rate, unit, regressed) for the benchmarks in both,
+  where regressed means the new rate is more than threshold (a fraction)
+  below the old one.  The legacy_ baselines are listed but never count as
+  regressions, since they are not the code under test.
+
+  >>> old = {'results': {'f': {'rates': {'trees': 100.0}}, 'g': {'rates': {'rules': 10.0}},
+  ...                    'legacy_f': {'rates': {'trees': 50.0}}}, 'order': ['legacy_f', 'f', 'g']}
+  >>> new = {'results': {'f': {'rates': {'trees': 85.0}}, 'g': {'rates': {'rules': 9.5}},
+  ...                    'legacy_f': {'rates': {'trees': 40.0}}}, 'order': ['legacy_f', 'f', 'g']}
+  >>> compare_reports(old, new)
+  [('legacy_f', 50.0, 40.0, 'trees', False), ('f', 100.0, 85.0, 'trees', True), ('g', 10.0, 9.5, 'rules', False)]
+  '''
+  out = []
+  for name in new['order']:
+    if name not in old['results']:
+      continue
+    (before, after) = (old['results'][name]['rates'], new['results'][name]['rates'])
+    unit = sorted(set(before) & set(after))[0]
+    regressed = not name.startswith('legacy_') and after[unit] < before[unit] * (1 - threshold)
+    out.append((name, before[unit], after[unit], unit, regressed))
+  return out
+
+def write_report(report, fh):
+  groups = {}
+  speedups = []
+  for name in report['order']:
+    result = report['results'][name]
+    groups.setdefault(result['group'], []).append(name)
+    rates = ' '.join("%14.1f %s/s" % (rate, unit) for (unit, rate) in sorted(result['rates'].items(), key=lambda x: x[1]))
+    fh.write("%-32s %8.3f s %s\n" % (name, result['secs'], rates))
+    if result.get('baseline') is not None:
+      speedups.append((result['group'], name, result['baseline']))
+  for (group, func) in BENCHMARKS:
+    if group not in groups:
+      continue
+    for (where, name, baseline) in speedups:
+      if where == group:
+        fh.write("%-32s %s %.2fx faster than %s\n" % (group, name, report['results'][baseline]['secs'] / report['results'][name]['secs'], baseline))
+    if report['memory'][group] is not None:
+      fh.write("%-32s peak +%d KB\n" % (group, report['memory'][group]))
+
+def main():
+  parser = argparse.ArgumentParser(description="benchmark the library's hot paths over synthetic data")
+  parser.add_argument("--sentences", "-n", type=int, default=2000, help="number of trees, rules and s-expressions (default 2000)")
+  parser.add_argument("--length", "-l", type=int, default=25, help="words per sentence (default 25)")
+  parser.add_argument("--depth", "-d", type=int, default=8, help="maximum phrase depth (default 8)")
+  parser.add_argument("--branching", "-b", type=int, default=3, help="maximum children per phrase (default 3)")
+  parser.add_argument("--seed", "-s", type=int, default=0, help="random seed (default 0)")
+  parser.add_argument("--repeat", "-r", type=int, default=5, help="report the best of this many runs (default 5)")
+  parser.add_argument("--only", nargs='+', choices=[name for (name, func) in BENCHMARKS], default=None, help="run only these benchmark groups")
+  parser.add_argument("--save", type=argparse.FileType('w'), default=None, help="write the results as json")
+  parser.add_argument("--compare", type=argparse.FileType('r'), default=None, help="json results of an earlier run to compare against")
+  parser.add_argument("--threshold", "-t", type=float, default=0.1, help="fractional slowdown counted as a regression (default 0.1)")
+  parser.add_argument("--outfile", "-o", nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="output file")
+
+  try:
+    args = parser.parse_args()
+  except IOError, msg:
+    parser.error(str(msg))
+
+  corpus = synthetic_corpus(args.sentences, args.length, args.depth, args.branching, args.seed)
+  report = run(corpus, args.only, args.repeat, args.seed)
+  write_report(report, args.outfile)
+  if args.only is None:
+    for (name, size, nodes) in bench_memory(corpus):
+      args.outfile.write("%-32s %8.1f bytes/node over %d nodes\n" % (name, float(size) / nodes, nodes))
+  if args.save is not None:
+    report['args'] = vars(args).copy()
+    for key in ('save', 'compare', 'outfile'):
+      del report['args'][key]
+    json.dump(report, args.save, indent=1, sort_keys=True)
+  if args.compare is not None:
+    regressions = 0
+    for (name, before, after, unit, regressed) in compare_reports(json.load(args.compare), report, args.threshold):
+      args.outfile.write("%-32s %14.1f -> %14.1f %s/s %+6.1f%%%s\n" % (name, before, after, unit, 100.0 * (after - before) / before, "  REGRESSION" if regressed else ""))
+      regressions += regressed
+    if regressions > 0:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# named numpy arrays in one file, loaded through mmap without copying
+# the layout is a magic line, the length of a JSON header as 8 bytes, the
+# header, and then each array at an 8-byte aligned position given in the
+# header relative to the end of the header
+# usage:
+# >>> binfile.save('x.bin', 'MYFORMAT 1\n', [('a', numpy.arange(10))], {'note': 'hi'})
+# >>> (arrays, meta) = binfile.load('x.bin', 'MYFORMAT 1\n')
+import json
+import mmap
+import struct
+import numpy
+
+def _aligned(pos):
+  return (pos + 7) & ~7
+
+def save(filename, magic, arrays, meta=None):
+  '''Write the (name, numpy array) pairs in arrays, and meta, anything json
+  can hold, to filename.  Arrays are stored flat.
+
+  >>> import os, tempfile
+  >>> (fd, filename) = tempfile.mkstemp()
+  >>> save(filename, 'TEST 1\\n', [('a', numpy.arange(5, dtype=numpy.int32)), ('b', numpy.zeros(0))], {'n': 5})
+  >>> (arrays, meta) = load(filename, 'TEST 1\\n')
+  >>> (list(arrays['a']), len(arrays['b']), meta['n'], arrays['a'].flags.writeable)
+  ([0, 1, 2, 3, 4], 0, 5, False)
+  >>> del arrays; os.close(fd); os.remove(filename)
+  '''
+  arrays = [(name, numpy.ascontiguousarray(a).ravel()) for (name, a) in arrays]
+  layout = {}
+  pos = 0
+  for (name, a) in arrays:
+    layout[name] = (a.dtype.str, len(a), pos)
+    pos = _aligned(pos + a.nbytes)
+  header = json.dumps({'arrays': layout, 'meta': meta}, sort_keys=True)
+  start = _aligned(len(magic) + 8 + len(header))
+  with open(filename, 'wb') as f:
+    f.write(magic)
+    f.write(struct.pack('<q', len(header)))
+    f.write(header)
+    for (name, a) in arrays:
+      f.write('\0' * (start + layout[name][2] - f.tell()))
+      f.write(a.tostring())
+
+def load(filename, magic):
+  '''Map a file written by save into memory, returning (arrays, meta) where
+  arrays is a dict from name to a read-only numpy view of the file.  Loading
+  costs the same however large the arrays are.'''
+  with open(filename, 'rb') as f:
+    if f.read(len(magic)) != magic:
+      raise Exception("%s does not start with %s" % (filename, repr(magic)))
+    (size,) = struct.unpack('<q', f.read(8))
+    header = json.loads(f.read(size))
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  start = _aligned(len(magic) + 8 + size)
+  arrays = {}
+  for (name, (dtype, count, pos)) in header['arrays'].items():
+    if count == 0:
+      arrays[str(name)] = numpy.zeros(0, dtype=dtype)
+    else:
+      arrays[str(name)] = numpy.frombuffer(data, dtype=str(dtype), count=count, offset=start + pos)
+  return (arrays, header['meta'])
+
+
+if __name__ == '__main__':
+  print "Running doctest"
+  import doctest
+  doctest.testmod()
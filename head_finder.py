@@ -5,6 +5,8 @@
 # vim: set ts=2 sw=2 noet:
 
 import sys
+from collections import namedtuple
+import instrument
 
 #TODO: Handle other langauges
 
@@ -38,100 +40,186 @@ collins_mapping_table = {
   'META': ('right', [])
 }
 
-def add_head(head_map, tree, head):
-	tree_repr = (tree.span, tree.label)
-	head_map[tree_repr] = head
-
-def get_head(head_map, tree):
-	tree_repr = (tree.span, tree.label)
-	return head_map[tree_repr]
-
-def first_search(tree, options, head_map):
-	for subtree in tree.subtrees:
-		if get_head(head_map, subtree)[2] in options or subtree.label in options:
-			add_head(head_map, tree, get_head(head_map, subtree))
-			return True
-	return False
-
-def last_search(tree, options, head_map):
-	for i in xrange(len(tree.subtrees) - 1, -1, -1):
-		subtree = tree.subtrees[i]
-		if get_head(head_map, subtree)[2] in options or subtree.label in options:
-			add_head(head_map, tree, get_head(head_map, subtree))
-			return True
-	return False
-
-def collins_NP(tree, head_map):
-	for subtree in tree.subtrees:
-		collins_find_heads(subtree, head_map)
-	#TODO:todo Extra special cases for NPs
+# Collins' NP rules, which replace the NP row of his table, as (direction,
+# labels) groups tried in order:
 ###	Ignore the row for NPs -- I use a special set of rules for this. For these
 ###	I initially remove ADJPs, QPs, and also NPs which dominate a possesive
 ###	(tagged POS, e.g.  (NP (NP the man 's) telescope ) becomes
 ###	(NP the man 's telescope)). These are recovered as a post-processing stage
 ###	after parsing. The following rules are then used to recover the NP head:
-
-	#TODO:todo handle NML properly
-
-	if get_head(head_map, tree.subtrees[-1])[2] == 'POS':
-		add_head(head_map, tree, get_head(head_map, tree.subtrees[-1]))
-		return
-	if last_search(tree, set(['NN', 'NNP', 'NNPS', 'NNS', 'NX', 'POS', 'JJR']), head_map):
-		return
-	if first_search(tree, set(['NP', 'NML']), head_map):
-		return
-	if last_search(tree, set(['$', 'ADJP', 'PRN']), head_map):
-		return
-	if last_search(tree, set(['CD']), head_map):
-		return
-	if last_search(tree, set(['JJ', 'JJS', 'RB', 'QP']), head_map):
-		return
-	add_head(head_map, tree, get_head(head_map, tree.subtrees[-1]))
-
-def collins_find_heads(tree, head_map=None):
+# a last child headed by POS comes first and the last child is the fallback;
+# compile_head_rules adds both
+#TODO:todo handle NML properly
+collins_NP_groups = [
+	('right', ['NN', 'NNP', 'NNPS', 'NNS', 'NX', 'POS', 'JJR']),
+	('left', ['NP', 'NML']),
+	('right', ['$', 'ADJP', 'PRN']),
+	('right', ['CD']),
+	('right', ['JJ', 'JJS', 'RB', 'QP']),
+]
+
+WILDCARDS = set(['**', '****'])
+
+# A compiled rule: priority maps a label to the index of the first group it
+# is in, last[g] says whether group g takes its rightmost match, wildcard is
+# the group (if any) that matches every child, default_last says which end to
+# take when nothing matches, and pos_last says to take a last child headed
+# by POS before anything else.
+HeadRule = namedtuple('HeadRule', ['priority', 'last', 'wildcard', 'default_last', 'pos_last'])
+
+def compile_rule(direction, groups, default=None, pos_last=False):
+	"""Compile a list of (direction, labels) groups into a HeadRule.  The
+	default direction, used when no group matches, is the first group's
+	unless given."""
+	priority = {}
+	last = []
+	wildcard = None
+	for (g, (group_direction, labels)) in enumerate(groups):
+		if group_direction not in ('left', 'right'):
+			raise Exception("Unknown head rule direction %s" % str(group_direction))
+		last.append(group_direction == 'right')
+		for label in labels:
+			if label in WILDCARDS:
+				if wildcard is None:
+					wildcard = g
+			elif label not in priority:
+				priority[label] = g
+	if default is None:
+		default = direction
+	return HeadRule(priority, tuple(last), wildcard, default == 'right', pos_last)
+
+def compile_head_rules(table, np_groups=collins_NP_groups):
+	"""Compile a table like collins_mapping_table, label -> (direction,
+	labels), into a dict from label to HeadRule.  Each label of a rule is its
+	own group, searched in the rule's direction, so a node needs one pass over
+	its children instead of one per label.  NP and NML get the np_groups rules
+	unless the table has its own rule for them.
+
+	>>> rules = compile_head_rules({'PP': ('left', ['IN', 'TO']), 'FRAG': ('right', ['**'])})
+	>>> sorted(rules)
+	['FRAG', 'NML', 'NP', 'PP']
+	>>> (rules['PP'].priority['TO'], rules['PP'].last, rules['FRAG'].wildcard)
+	(1, (False, False), 0)
+	"""
+	rules = {}
+	for (label, (direction, labels)) in table.items():
+		rules[label] = compile_rule(direction, [(direction, [l]) for l in labels])
+	if np_groups is not None:
+		for label in ('NP', 'NML'):
+			if label not in rules:
+				rules[label] = compile_rule('right', np_groups, 'right', True)
+	return rules
+
+def load_head_rules(lines):
+	"""Read a head table in either of the formats quoted at the bottom of this
+	file, returning a table like collins_mapping_table for compile_head_rules.
+	Each line is a label, a direction and the labels in priority order, the
+	direction being left or right (Magerman) or 1 or 0 (Collins, whose lines
+	also start with a field count).  Blank lines and lines starting with #
+	are skipped.
+
+	>>> table = load_head_rules(["ADJP	right	% QP JJ **** RB", "", "8 PP	1	IN TO VBG VBN RP FW", "2 FRAG	1"])
+	>>> sorted(table.items())
+	[('ADJP', ('right', ['%', 'QP', 'JJ', '****', 'RB'])), ('FRAG', ('left', [])), ('PP', ('left', ['IN', 'TO', 'VBG', 'VBN', 'RP', 'FW']))]
+	"""
+	table = {}
+	for (number, line) in enumerate(lines):
+		fields = line.split()
+		if len(fields) == 0 or fields[0].startswith('#'):
+			continue
+		if fields[0].isdigit():
+			fields = fields[1:]
+		if len(fields) < 2 or fields[1] not in ('left', 'right', '0', '1'):
+			raise Exception("Bad head rule at line %d: %s" % (number + 1, line.rstrip()))
+		direction = {'0': 'right', '1': 'left'}.get(fields[1], fields[1])
+		table[fields[0]] = (direction, fields[2:])
+	return table
+
+collins_rules = compile_head_rules(collins_mapping_table)
+
+def choose_head(rule, subtrees, heads):
+	"""Index of the head among subtrees, whose heads are given, under rule."""
+	n = len(subtrees)
+	if rule.pos_last and heads[-1][2] == 'POS':
+		return n - 1
+	priority = rule.priority
+	last = rule.last
+	nomatch = len(last)
+	wildcard = nomatch if rule.wildcard is None else rule.wildcard
+	best = None
+	best_group = nomatch
+	for i in xrange(n):
+		group = min(priority.get(subtrees[i].label, nomatch), priority.get(heads[i][2], nomatch), wildcard)
+		if group < best_group or (group == best_group and group < nomatch and last[group]):
+			best = i
+			best_group = group
+	if best is None:
+		return n - 1 if rule.default_last else 0
+	return best
+
+def find_heads(tree, rules=None, head_map=None):
+	"""Fill head_map, keyed by (span, label), with the (span, word, tag) head
+	of every node of a PSTree, using compiled rules (collins_rules by default).
+	Nodes whose label has no rule take the head of their last subtree.  The
+	tree is walked without recursion."""
+	if rules is None:
+		rules = collins_rules
 	if head_map is None:
 		head_map = {}
-	for subtree in tree.subtrees:
-		collins_find_heads(subtree, head_map)
-
-	# A word is it's own head
-	if tree.word is not None:
-		head = (tree.span, tree.word, tree.label)
-		add_head(head_map, tree, head)
-		return head_map
-
-	# If the label for this node is not in the table we are either at the bottom,
-	# at an NP, or have an error
-	if tree.label not in collins_mapping_table:
-		if tree.label in ['NP', 'NML']:
-			collins_NP(tree, head_map)
-		else:
+	stack = [(tree, False)]
+	while len(stack) > 0:
+		(node, done) = stack.pop()
+		# A word is it's own head
+		if node.word is not None:
+			head_map[(node.span, node.label)] = (node.span, node.word, node.label)
+			continue
+		if not done:
+			stack.append((node, True))
+			for i in xrange(len(node.subtrees) - 1, -1, -1):
+				stack.append((node.subtrees[i], False))
+			continue
+		subtrees = node.subtrees
+		heads = [head_map[(subtree.span, subtree.label)] for subtree in subtrees]
+		rule = rules.get(node.label)
+		if rule is None:
 			# TODO: Consider alternative error announcement means
 ###			if tree.label not in ['ROOT', 'TOP', 'S1', '']:
 ###				print >> sys.stderr, "Unknown Label: %s" % tree.label
 ###				print >> sys.stderr, "In tree:", tree.root()
-			add_head(head_map, tree, get_head(head_map, tree.subtrees[-1]))
-		return head_map
-
-	# Look through and take the first/last occurrence that matches
-	info = collins_mapping_table[tree.label]
-	for label in info[1]:
-		for i in xrange(len(tree.subtrees)):
-			if info[0] == 'right':
-				i = len(tree.subtrees) - i - 1
-			subtree = tree.subtrees[i]
-			if subtree.label == label or get_head(head_map, subtree)[2] == label:
-				add_head(head_map, tree, get_head(head_map, subtree))
-				return head_map
-
-	# Final fallback
-	if info[0] == 'left':
-		add_head(head_map, tree, get_head(head_map, tree.subtrees[0]))
-	else:
-		add_head(head_map, tree, get_head(head_map, tree.subtrees[-1]))
+			instrument.count('head_finder.unknown_label')
+			head = heads[-1]
+		else:
+			head = heads[choose_head(rule, subtrees, heads)]
+		head_map[(node.span, node.label)] = head
+	return head_map
 
+def collins_NP(tree, head_map):
+	"""Fill head_map with the heads of tree and everything under it, taking
+	the head of tree itself by the NP rules whatever its label.
+
+	>>> import pstree
+	>>> tree = pstree.tree_from_text("(X (NP (NNP John) (POS 's)) (NN dog) (CD 2))")
+	>>> collins_NP(tree, {})[(tree.span, tree.label)][1]
+	'dog'
+	"""
+	for subtree in tree.subtrees:
+		find_heads(subtree, collins_rules, head_map)
+	heads = [head_map[(subtree.span, subtree.label)] for subtree in tree.subtrees]
+	head_map[(tree.span, tree.label)] = heads[choose_head(collins_rules['NP'], tree.subtrees, heads)]
 	return head_map
 
+def collins_find_heads(tree, head_map=None):
+	"""find_heads with the Collins rules compiled from collins_mapping_table
+	when this module was loaded.
+
+	>>> import pstree
+	>>> tree = pstree.tree_from_text("(ROOT (S (NP (NP (NNP John) (POS 's)) (NN dog)) (VP (VBD barked))))")
+	>>> head_map = collins_find_heads(tree)
+	>>> [head_map[(node.span, node.label)][1] for node in tree if node.word is None]
+	['barked', 'barked', 'dog', "'s", 'barked']
+	"""
+	return find_heads(tree, collins_rules, head_map)
+
 '''Text from Collins' website:
 
 This file describes the table used to identify head-words in the papers
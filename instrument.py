@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# named timers and counters that can be left in hot code
+# usage:
+# >>> import instrument
+# >>> instrument.enable()
+# >>> with instrument.scope('load'):
+# ...     trees = [pstree.tree_from_text(line) for line in open('wsj.mrg')]
+# ...     with instrument.scope('heads'):        # recorded as load/heads
+# ...         maps = [t.head_map() for t in trees]
+# >>> instrument.report()                        # to log.file
+# while disabled (the default) scope() returns a shared do-nothing context,
+# timed functions go straight through after one flag test, and count()
+# returns at once, so the hooks can stay in the code.  Innermost loops
+# should still test instrument.enabled themselves.
+import time
+import random
+import functools
+import log
+
+enabled = False
+RESERVOIR = 1024
+
+_stats = {}
+_counters = {}
+_path = []
+_rng = random.Random(0)
+
+class Stat:
+  '''Running count, total, min and max of a series of timings, with a
+  uniform reservoir sample of at most RESERVOIR of them for percentiles.'''
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self.samples = []
+
+  def add(self, value):
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    if len(self.samples) < RESERVOIR:
+      self.samples.append(value)
+    else:
+      i = _rng.randrange(self.count)
+      if i < RESERVOIR:
+        self.samples[i] = value
+
+  def percentile(self, p):
+    '''The p-th percentile (0-100) of the sampled values.
+
+    >>> stat = Stat()
+    >>> for i in xrange(1, 101): stat.add(i)
+    >>> (stat.percentile(50), stat.percentile(95), stat.percentile(99), stat.max)
+    (50, 95, 99, 100)
+    '''
+    if len(self.samples) == 0:
+      return None
+    ordered = sorted(self.samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+class _Scope:
+  '''Times the enclosed block under its name nested in the enclosing
+  scopes.'''
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    _path.append(self.name)
+    self.start = time.time()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    elapsed = time.time() - self.start
+    key = '/'.join(_path)
+    _path.pop()
+    try:
+      stat = _stats[key]
+    except KeyError:
+      stat = _stats[key] = Stat()
+    stat.add(elapsed)
+    return False
+
+class _NullScope:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    return False
+
+_null = _NullScope()
+
+def enable(flag=True):
+  global enabled
+  enabled = flag
+
+def reset():
+  '''Forget everything recorded so far.'''
+  _stats.clear()
+  _counters.clear()
+
+def scope(name):
+  '''Context manager timing its block as name, nested under any enclosing
+  scopes.
+
+  >>> enable(); reset()
+  >>> with scope('outer'):
+  ...   with scope('inner'):
+  ...     pass
+  >>> sorted((key, stat.count) for (key, stat) in stats().items())
+  [('outer', 1), ('outer/inner', 1)]
+  >>> enable(False); reset()
+  >>> with scope('outer'):
+  ...   pass
+  >>> stats()
+  {}
+  '''
+  return _Scope(name) if enabled else _null
+
+def timed(name=None):
+  '''Decorator timing every call of a function, with any arguments, as a
+  scope called name (module.function by default).
+
+  >>> @timed('f')
+  ... def f(x, y=1): return x + y
+  >>> enable(); reset()
+  >>> f(1, y=2)
+  3
+  >>> [(key, stat.count) for (key, stat) in stats().items()]
+  [('f', 1)]
+  >>> enable(False); reset()
+  '''
+  def decorate(func):
+    key = name if name is not None else "%s.%s" % (func.__module__, func.__name__)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if not enabled:
+        return func(*args, **kwargs)
+      with _Scope(key):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorate
+
+def count(name, n=1):
+  '''Add n to the counter called name.
+
+  >>> enable(); reset()
+  >>> for i in xrange(3): count('things', 2)
+  >>> counters()
+  {'things': 6}
+  >>> enable(False); reset()
+  '''
+  if enabled:
+    _counters[name] = _counters.get(name, 0) + n
+
+def record(name, seconds):
+  '''Add a timing taken some other way to the stat called name, nested
+  under the current scopes.'''
+  if enabled:
+    name = '/'.join(_path + [name])
+    try:
+      stat = _stats[name]
+    except KeyError:
+      stat = _stats[name] = Stat()
+    stat.add(seconds)
+
+def stats():
+  '''dict from scope path to Stat'''
+  return _stats
+
+def counters():
+  return _counters
+
+def report(fh=None):
+  '''Write every timer, nested under its parents, and every counter to fh,
+  log.file by default.  Times are in milliseconds.'''
+  if fh is None:
+    fh = log.file
+  if len(_stats) > 0:
+    fh.write("%-40s %10s %10s %10s %10s %10s %10s %10s\n" % ('scope', 'calls', 'total', 'mean', 'p50', 'p95', 'p99', 'max'))
+  for key in sorted(_stats, key=lambda key: key.split('/')):
+    stat = _stats[key]
+    parts = key.split('/')
+    fh.write("%-40s %10d %10.1f %10.3f %10.3f %10.3f %10.3f %10.3f\n" %
+             ('  ' * (len(parts) - 1) + parts[-1], stat.count, stat.total * 1000, stat.total * 1000 / stat.count,
+              stat.percentile(50) * 1000, stat.percentile(95) * 1000, stat.percentile(99) * 1000, stat.max * 1000))
+  for key in sorted(_counters):
+    fh.write("%-40s %10d\n" % (key, _counters[key]))
+  fh.flush()
+
+
+if __name__ == '__main__':
+  print "Running doctest"
+  import doctest
+  doctest.testmod()
@@ -59,6 +59,36 @@ def list_to_dict(l, tuple_size=2, key=0, val=1):
     # http://stackoverflow.com/questions/4576115/python-list-to-dictionary
     return dict(zip(l[key::tuple_size], l[val::tuple_size]))
 
+class Vocab:
+  ''' two-way map between strings and dense integer ids, in order of first sight '''
+  def __init__(self, strings=()):
+    self.strings = []
+    self.ids = {}
+    for string in strings:
+      self.id(string)
+
+  def __len__(self):
+    return len(self.strings)
+
+  def __contains__(self, string):
+    return string in self.ids
+
+  def id(self, string):
+    ''' return the id of string, adding it if it is new '''
+    try:
+      return self.ids[string]
+    except KeyError:
+      self.ids[string] = len(self.strings)
+      self.strings.append(string)
+      return self.ids[string]
+
+  def get(self, string, default=-1):
+    ''' return the id of string without adding it '''
+    return self.ids.get(string, default)
+
+  def string(self, i):
+    return self.strings[i]
+
 def ngram(data, n, sep=' ', pref='START'):
     ''' given a list of tokens, return a list of n-grams by joining with sep, prepending with pref '''
     ret = []
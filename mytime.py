@@ -8,16 +8,23 @@
 # tested with Python24 vegaseat 21aug2005
 #
  
+# takes keyword arguments too, and when instrument is enabled the time is
+# also recorded there under the function's name.  For functions called in
+# hot loops use instrument.timed instead, which only aggregates.
 #
 import time
+import functools
+import instrument
 #
  
 #
 def print_timing(func):
-    def wrapper(*arg):
+    @functools.wraps(func)
+    def wrapper(*arg, **kwargs):
         t1 = time.time()
-        res = func(*arg)
+        res = func(*arg, **kwargs)
         t2 = time.time()
         print '%s took %0.3f ms' % (func.func_name, (t2-t1)*1000.0)
+        instrument.record(func.func_name, t2-t1)
         return res
     return wrapper
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# run a per-tree function over a treebank on several cores, writing the
+# results in input order
+# usage:
+#   pipeline.py -i wsj.mrg -o wsj.heads -f pipeline.heads -w 8
+# or from python, with any function importable by name (so that worker
+# processes can find it):
+# >>> import pipeline
+# >>> with open('wsj.mrg') as fin, open('out', 'w') as fout:
+# ...     pipeline.process_treebank(fin, fout, mymodule.myfunc, workers=8)
+import argparse
+import sys
+import importlib
+import multiprocessing
+from collections import deque
+from itertools import islice
+import pstree
+import tree as chiangtree
+import treebank
+
+def _map_chunk(func, chunk):
+  return [func(item) for item in chunk]
+
+def ordered_map(func, items, workers=None, chunksize=64, max_pending=None):
+  '''Yield func(item) for each item, in the order of items, computing them
+  in a pool of worker processes.  Items are sent out in chunks of chunksize
+  and at most max_pending chunks (default twice the number of workers) are
+  in flight at once, so memory stays bounded however long items is.  With
+  workers=1 everything runs in this process, which is easier to debug.
+  func must be picklable: a module-level function or an instance of a
+  module-level class.
+
+  >>> list(ordered_map(abs, xrange(-5, 5), workers=2, chunksize=3))
+  [5, 4, 3, 2, 1, 0, 1, 2, 3, 4]
+  >>> list(ordered_map(abs, [-1, 2], workers=1))
+  [1, 2]
+  '''
+  if workers == 1:
+    for item in items:
+      yield func(item)
+    return
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if max_pending is None:
+    max_pending = 2 * workers
+  items = iter(items)
+  pool = multiprocessing.Pool(workers)
+  try:
+    pending = deque()
+    while True:
+      chunk = list(islice(items, chunksize))
+      if len(chunk) == 0:
+        break
+      pending.append(pool.apply_async(_map_chunk, (func, chunk)))
+      if len(pending) >= max_pending:
+        for result in pending.popleft().get():
+          yield result
+    while len(pending) > 0:
+      for result in pending.popleft().get():
+        yield result
+  finally:
+    pool.terminate()
+    pool.join()
+
+class TreeTask:
+  '''Picklable wrapper that parses a tree's text and applies func to it.
+  kind is 'pstree' for pstree.PSTree or 'node' for tree.Node.'''
+  def __init__(self, func, kind='pstree', **kwargs):
+    if kind not in ('pstree', 'node'):
+      raise Exception("%s is not a valid tree kind" % str(kind))
+    self.func = func
+    self.kind = kind
+    self.kwargs = kwargs
+
+  def __call__(self, text):
+    if self.kind == 'pstree':
+      return self.func(pstree.tree_from_text(text, **self.kwargs))
+    node = chiangtree.str_to_tree(text)
+    if node is None:
+      raise Exception("Could not parse tree\n%s" % text)
+    return self.func(node)
+
+def process_treebank(infile, outfile, func, workers=None, kind='pstree', chunksize=64, max_pending=None, **kwargs):
+  '''Read every tree in infile, apply func to it and write the results to
+  outfile in input order, one per line; a result of None writes nothing.
+  Extra keyword arguments go to pstree.tree_from_text.  Returns the number
+  of trees read.'''
+  texts = (text for (index, offset, text) in treebank.read_tree_texts(infile))
+  count = 0
+  for result in ordered_map(TreeTask(func, kind, **kwargs), texts, workers, chunksize, max_pending):
+    count += 1
+    if result is not None:
+      outfile.write("%s\n" % result)
+  return count
+
+# ready-made per-tree functions
+
+def reserialize(tree):
+  '''The tree on one line.'''
+  return str(tree)
+
+def heads(tree):
+  '''label:start-end:head for every phrase of a PSTree, using
+  head_finder.collins_find_heads.'''
+  head_map = tree.head_map()
+  return ' '.join("%s:%d-%d:%s" % (node.label, node.span[0], node.span[1], head_map[(node.span, node.label)][1])
+                  for node in tree if not node.is_terminal())
+
+def load_function(name):
+  '''Find a function given as module.function.'''
+  (module, dot, func) = name.rpartition('.')
+  if module == '':
+    raise Exception("%s should be given as module.function" % name)
+  return getattr(importlib.import_module(module), func)
+
+def main():
+  parser = argparse.ArgumentParser(description="apply a per-tree function to a treebank in parallel, keeping input order")
+  parser.add_argument("--infile", "-i", nargs='?', type=argparse.FileType('r'), default=sys.stdin, help="input treebank")
+  parser.add_argument("--outfile", "-o", nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="output file")
+  parser.add_argument("--function", "-f", default="pipeline.reserialize", help="module.function to apply to each tree (default pipeline.reserialize)")
+  parser.add_argument("--kind", "-k", choices=['pstree', 'node'], default='pstree', help="build pstree.PSTree or tree.Node trees (default pstree)")
+  parser.add_argument("--workers", "-w", type=int, default=None, help="worker processes; 1 runs in-process (default: all cores)")
+  parser.add_argument("--chunksize", "-c", type=int, default=64, help="trees per task (default 64)")
+  parser.add_argument("--max_pending", "-m", type=int, default=None, help="tasks in flight at once (default twice the workers)")
+
+  try:
+    args = parser.parse_args()
+  except IOError, msg:
+    parser.error(str(msg))
+
+  func = load_function(args.function)
+  process_treebank(args.infile, args.outfile, func, args.workers, args.kind, args.chunksize, args.max_pending)
+
+if __name__ == '__main__':
+  main()
@@ -14,8 +14,11 @@
 # this time , the us selling weapons to taiwan is as high as more than us $ 5.8 billion , gross interference in the internal affairs of our country .
 
 # -*- coding: utf-8 -*-
+import re
+from bisect import bisect_left
 import jmutil
 import head_finder as hf
+import instrument
 
 from collections import defaultdict
 
@@ -41,40 +44,42 @@ class TreeIterator:
   (ROOT (S (NP-SBJ (NNP Ms.) (NNP Haag)) (VP (VBZ plays) (NP (NNP Elianti))) (. .)))
   '''
   def __init__(self, tree, order='pre'):
-    self.tree = tree
-    self.pos = [0]
+    # pre-order keeps the nodes still to visit, last first; post-order keeps
+    # each open node with an iterator over its remaining subtrees.  Neither
+    # follows parent links, so a clone whose subtrees are shared with another
+    # tree is walked within the clone.
     self.order = order
+    if order == 'pre':
+      self.stack = [tree]
+    else:
+      self.stack = [(tree, iter(tree.subtrees))]
 
   def __iter__(self):
     return self
 
   def next(self):
-    while True:
-      if len(self.pos) == 0:
+    stack = self.stack
+    if self.order == 'pre':
+      if len(stack) == 0:
         raise StopIteration
-
-      # For pre-order traversal, return nodes when first reached
-      ans = None
-      if self.order == 'pre' and self.pos[-1] == 0:
-        ans = self.tree
-
-      # Update internal state to point at the next node in the tree
-      if self.pos[-1] < len(self.tree.subtrees):
-        self.tree = self.tree.subtrees[self.pos[-1]]
-        self.pos[-1] += 1
-        self.pos.append(0)
+      node = stack.pop()
+      stack.extend(reversed(node.subtrees))
+      return node
+    while len(stack) > 0:
+      for subtree in stack[-1][1]:
+        stack.append((subtree, iter(subtree.subtrees)))
+        break
       else:
-        if self.order == 'post':
-          ans = self.tree
-        self.tree = self.tree.parent
-        self.pos.pop()
-
-      if ans is not None:
-        return ans
+        return stack.pop()[0]
+    raise StopIteration
 
-class PSTree:
+class PSTree(object):
   '''Phrase Structure Tree
 
+  Nodes keep their fields in __slots__ rather than a per-node dict, and the
+  labels and words read by tree_from_text are interned, so a large treebank
+  holds one copy of 'NP' rather than one per node.
+
   >>> tree = tree_from_text("(ROOT (NP (NNP Newspaper)))")
   >>> print tree
   (ROOT (NP (NNP Newspaper)))
@@ -94,6 +99,12 @@ class PSTree:
   >>> tree.word_yield()
   'was named *-1 a nonexecutive director of this British industrial conglomerate'
   '''
+  _fields = ('word', 'label', 'span', 'parent', 'subtrees')
+  # results cached on the root of a tree; see invalidate()
+  _caches = ('_head_map', '_span_index', '_yields')
+  # set on a node once it is the subtree of more than one tree; see clone()
+  __slots__ = _fields + _caches + ('_shared',)
+
   def __init__(self, word=None, label=DEFAULT_LABEL, span=(0, 0), parent=None, subtrees=None):
     self.word = word
     self.label = label
@@ -108,7 +119,43 @@ class PSTree:
   def __iter__(self):
     return TreeIterator(self, 'pre')
 
-  def clone(self):
+  def __getstate__(self):
+    return dict((name, getattr(self, name)) for name in PSTree._fields)
+
+  def __setstate__(self, state):
+    for (name, value) in state.items():
+      setattr(self, name, value)
+
+  def clone(self, share=False):
+    '''Return a copy of this subtree as a new tree.
+
+    With share, only this node is copied and the copy's subtrees are the
+    same objects as this node's, so making a variant of a large tree costs
+    about the size of the edit.  The shared nodes are marked, and from then
+    on both trees, this one as well as the copy, must be changed through
+    edit(), which copies the shared nodes on the path it is given.  A shared
+    node's parent is in the tree it was made in, so parent and root() only
+    lead back to a clone from nodes edit() returns.
+
+    >>> tree = tree_from_text("(ROOT (S (NP (DT the) (NN cow)) (VP (VBZ moos))))")
+    >>> variant = tree.clone(share=True)
+    >>> variant.edit([0, 1, 0]).word = 'grazes'
+    >>> tree.edit([0, 0]).label = 'NP-SBJ'
+    >>> print variant
+    (ROOT (S (NP (DT the) (NN cow)) (VP (VBZ grazes))))
+    >>> print tree
+    (ROOT (S (NP-SBJ (DT the) (NN cow)) (VP (VBZ moos))))
+    >>> variant.subtrees[0].subtrees[0].subtrees[0] is tree.subtrees[0].subtrees[0].subtrees[0]
+    True
+    >>> [node.label for node in variant if node.is_terminal()]
+    ['DT', 'NN', 'VBZ']
+    '''
+    if share:
+      ans = PSTree(self.word, self.label, self.span)
+      ans.subtrees = list(self.subtrees)
+      for subtree in ans.subtrees:
+        subtree._shared = True
+      return ans
     ans = PSTree(self.word, self.label, self.span)
     for subtree in self.subtrees:
       subclone = subtree.clone()
@@ -116,6 +163,40 @@ class PSTree:
       ans.subtrees.append(subclone)
     return ans
 
+  def is_shared(self):
+    '''Check if this node may be a subtree of more than one tree.'''
+    return getattr(self, '_shared', False)
+
+  def edit(self, path):
+    '''Return the node reached from this one by following path, a list of
+    subtree positions, ready to be changed in place: any node on the way
+    that is shared with another tree is first replaced by a copy of its own
+    (whose subtrees are in turn shared).  The returned node's subtrees list
+    belongs to it, so subtrees may be replaced or appended there, but the
+    subtrees themselves are changed through edit() as well.  Drops the
+    results cached on the root, as invalidate() does.'''
+    if self.is_shared():
+      raise Exception("Shared nodes are edited from the root of their tree")
+    self.invalidate()
+    node = self
+    for i in path:
+      subtree = node.subtrees[i]
+      if subtree.is_shared():
+        subtree = node._unshare(i)
+      node = subtree
+    return node
+
+  def _unshare(self, i):
+    '''Replace the shared subtree at position i with a copy that belongs to
+    this node.'''
+    shared = self.subtrees[i]
+    ans = PSTree(shared.word, shared.label, shared.span, self)
+    ans.subtrees = list(shared.subtrees)
+    for subtree in ans.subtrees:
+      subtree._shared = True
+    self.subtrees[i] = ans
+    return ans
+
   def is_terminal(self):
     '''Check if the tree has no children.'''
     return len(self.subtrees) == 0
@@ -126,32 +207,73 @@ class PSTree:
 
   def root(self):
     '''Follow parents until a node is reached that has no parent.'''
-    if self.parent is not None:
-      return self.parent.root()
-    else:
-      return self
+    node = self
+    while node.parent is not None:
+      node = node.parent
+    return node
+
+  def invalidate(self):
+    '''Drop the results cached on the root of this tree, such as the head map.
+    calculate_spans does this itself; call it after any other change to the
+    tree's structure, labels or words.'''
+    root = self.root()
+    for name in PSTree._caches:
+      if hasattr(root, name):
+        delattr(root, name)
 
   def __repr__(self):
     '''Return a bracket notation style representation of the tree.'''
-    ans = '('
+    out = []
+    self.pieces(out)
+    return ''.join(out)
+
+  def pieces(self, out):
+    '''Append the pieces of __repr__ to the list out, without recursion, so
+    that many trees can be joined or written at once.  Each level keeps an
+    iterator over its subtrees on a stack; terminals are written as they are
+    met and a phrase is opened and descended into.'''
     if self.is_trace():
-      ans += TRACE_LABEL + ' ' + self.word
+      out.append('(' + TRACE_LABEL + ' ' + self.word)
     elif self.is_terminal():
-      ans += self.label + ' ' + self.word
+      out.append('(' + self.label + ' ' + self.word + ')')
+      return
     else:
-      ans += self.label
-    for subtree in self.subtrees:
-      ans += ' ' + subtree.__repr__()
-    ans += ')'
-    return ans
+      out.append('(' + self.label)
+    stack = [iter(self.subtrees)]
+    while len(stack) > 0:
+      for subtree in stack[-1]:
+        if len(subtree.subtrees) == 0:
+          # a terminal, or the end of a trace, which writes the same way
+          out.append(' (' + subtree.label + ' ' + subtree.word + ')')
+          continue
+        if subtree.label == TRACE_LABEL:
+          out.append(' (' + TRACE_LABEL + ' ' + subtree.word)
+        else:
+          out.append(' (' + subtree.label)
+        stack.append(iter(subtree.subtrees))
+        break
+      else:
+        out.append(')')
+        stack.pop()
 
   def calculate_spans(self, left=0):
     '''Update the spans for every node in this tree.'''
+    self.invalidate()
+    return self._calculate_spans(left)
+
+  def _calculate_spans(self, left):
     right = left
     if self.is_terminal():
       right += 1
-    for subtree in self.subtrees:
-      right = subtree.calculate_spans(right)
+    for i in xrange(len(self.subtrees)):
+      subtree = self.subtrees[i]
+      if subtree.is_shared():
+        if subtree.span[0] == right:
+          # unchanged since it was shared, so its spans are already right
+          right = subtree.span[1]
+          continue
+        subtree = self._unshare(i)
+      right = subtree._calculate_spans(right)
     self.span = (left, right)
     return right
 
@@ -162,7 +284,7 @@ class PSTree:
     if len(self.subtrees) > 0:
       for i in xrange(len(self.subtrees)):
         subtree = self.subtrees[i]
-        if subtree.parent != self:
+        if subtree.parent != self and not subtree.is_shared():
           print "bad parent link"
           ans = False
         if i > 0 and self.subtrees[i - 1].span[1] != subtree.span[0]:
@@ -186,9 +308,27 @@ class PSTree:
         sub.production_list(ans)
     return ans
 
+  def yields(self):
+    '''Return the Yields of this tree, built once and kept on the root until
+    invalidate() is called.'''
+    root = self.root()
+    try:
+      return root._yields
+    except AttributeError:
+      root._yields = Yields(root)
+      return root._yields
+
   def word_yield(self, span=None, as_list=False):
     '''Return the set of words at terminal nodes, either as a space separated
-    string, or as a list.'''
+    string, or as a list.  With a span, only terminals starting within it are
+    included.  The words are sliced from a list cached on the root.
+
+    >>> tree = tree_from_text("(ROOT (S (NP (DT the) (NN cow)) (VP (VBZ moos) (ADVP (RB loudly)))))")
+    >>> tree.word_yield(span=(1, 3))
+    'cow moos'
+    >>> tree.subtrees[0].subtrees[1].word_yield(as_list=True)
+    ['moos', 'loudly']
+    '''
     if self.is_terminal():
       if span is None or span[0] <= self.span[0] < span[1]:
         if self.word is None:
@@ -199,18 +339,29 @@ class PSTree:
           return self.word
       else:
         return None
-    else:
-      ans = []
-      for subtree in self.subtrees:
-        words = subtree.word_yield(span, as_list)
-        if words is not None:
-          if as_list:
-            ans += words
-          else:
-            ans.append(words)
-      if not as_list:
-        ans = ' '.join(ans)
-      return ans
+    ans = self.yields().select(self, span, 'words')
+    if not as_list:
+      ans = ' '.join(ans)
+    return ans
+
+  def tag_yield(self, span=None, as_list=False):
+    '''Return the labels of the terminal nodes that have words, in the same
+    way as word_yield.
+
+    >>> tree = tree_from_text("(ROOT (S (NP (DT the) (NN cow)) (VP (VBZ moos) (ADVP (RB loudly)))))")
+    >>> tree.tag_yield()
+    'DT NN VBZ RB'
+    >>> tree.tag_yield(span=(1, 3), as_list=True)
+    ['NN', 'VBZ']
+    '''
+    if self.is_terminal():
+      if self.word is not None and (span is None or span[0] <= self.span[0] < span[1]):
+        return [self.label] if as_list else self.label
+      return None
+    ans = self.yields().select(self, span, 'tags')
+    if not as_list:
+      ans = ' '.join(ans)
+    return ans
 
   def node_dict(self, depth=0, node_dict=None):
     '''Get a dictionary of labelled nodes. Note that we use a dictionary to
@@ -222,15 +373,59 @@ class PSTree:
     node_dict[(self.label, self.span[0], self.span[1])].append(depth)
     return node_dict
 
+  def span_index(self):
+    '''Return the SpanIndex of this tree, built once and kept on the root
+    until invalidate() is called.'''
+    root = self.root()
+    try:
+      return root._span_index
+    except AttributeError:
+      with instrument.scope('pstree.span_index'):
+        root._span_index = SpanIndex(root)
+      return root._span_index
+
   def get_nodes(self, request='all', start=-1, end=-1, node_list=None):
     '''Get the node(s) that have a given span.  Unspecified endpoints are
     treated as wildcards.  The request can be 'lowest', 'highest', or 'all'.
-    For 'all', the list of nodes is in order from the highest first.'''
+    For 'all', the list of nodes is in order from the highest first.
+
+    Called on the root, this is answered from the tree's span index.
+
+    >>> tree = tree_from_text("(ROOT (S (NP (NP (NNS Cows)) (PP (IN of) (NP (NN milk)))) (VP (VBP moo))))")
+    >>> print tree.get_nodes('highest', 0, 1)
+    (NP (NNS Cows))
+    >>> print tree.get_nodes('lowest', 0, 1)
+    (NNS Cows)
+    >>> for node in tree.get_nodes('all', start=0):
+    ...   print node.label, node.span
+    ROOT (0, 4)
+    S (0, 4)
+    NP (0, 3)
+    NP (0, 1)
+    NNS (0, 1)
+    >>> [node and node.label for node in tree.get_nodes_for_spans([(0, 3), (2, 3), (1, 4)], 'highest')]
+    ['NP', 'NP', None]
+    '''
     if request not in ['highest', 'lowest', 'all']:
       raise Exception("%s is not a valid request" % str(request))
     if request == 'lowest' and start < 0 and end < 0:
       raise Exception("Lowest is not well defined when both ends are wildcards")
+    if self.parent is not None or node_list is not None:
+      return self._find_nodes(request, start, end, node_list)
+    return self.span_index().get_nodes(request, start, end)
 
+  def get_nodes_for_spans(self, spans, request='highest'):
+    '''Answer get_nodes for each (start, end) in spans; see get_nodes.'''
+    if request not in ['highest', 'lowest', 'all']:
+      raise Exception("%s is not a valid request" % str(request))
+    if self.parent is not None:
+      return [self.get_nodes(request, start, end) for (start, end) in spans]
+    index = self.span_index()
+    return [index.get_nodes(request, start, end) for (start, end) in spans]
+
+  def _find_nodes(self, request, start, end, node_list):
+    '''get_nodes by walking the tree, for subtrees and for callers that pass
+    their own node_list.'''
     if request == 'all' and node_list is None:
       node_list = []
     if request == 'highest':
@@ -242,7 +437,7 @@ class PSTree:
       # Skip subtrees with no overlapping range
       if 0 < end <= subtree.span[0] or subtree.span[1] < start:
         continue
-      ans = subtree.get_nodes(request, start, end, node_list)
+      ans = subtree._find_nodes(request, start, end, node_list)
       if ans is not None and request != 'all':
         return ans
 
@@ -259,6 +454,16 @@ class PSTree:
       return None
 
   def get_spanning_nodes(self, start, end, node_list=None):
+    '''Get the smallest list of nodes, left to right, whose spans exactly
+    cover start to end, taking the highest node at each step; None if there
+    is no such list.
+
+    >>> tree = tree_from_text("(ROOT (S (NP (DT The) (NN cow)) (VP (VBZ eats) (NP (NN grass)))))")
+    >>> [node.label for node in tree.get_spanning_nodes(1, 4)]
+    ['NN', 'VP']
+    '''
+    if self.parent is None and node_list is None:
+      return self.span_index().get_spanning_nodes(start, end)
     return_ans = False
     if node_list is None:
       return_ans = True
@@ -283,75 +488,296 @@ class PSTree:
     else:
       return start
 
+  def head_map(self):
+    '''Return the head_finder.collins_find_heads map for the whole tree.  It is
+    computed once and kept on the root until invalidate() is called.'''
+    root = self.root()
+    try:
+      return root._head_map
+    except AttributeError:
+      with instrument.scope('pstree.head_map'):
+        root._head_map = hf.collins_find_heads(root)
+      return root._head_map
 
   def get_head(self, node):
-    ''' Get the head word given a node '''
-     # TODO: memoize the head finder
-    heads=hf.collins_find_heads(self)
-    key=(node[1:3], node[0])
-    val=heads[key]
-    return val[1]
+    ''' Get the head word given a node, either a PSTree in this tree or a
+    (label, start, end) tuple as used by node_dict
+
+    >>> tree = tree_from_text("(ROOT (S (NP (DT The) (NN cow)) (VP (VBZ moos))))")
+    >>> tree.get_head(('NP', 0, 2))
+    'cow'
+    >>> tree.get_heads([tree.subtrees[0], ('VP', 2, 3)])
+    ['moos', 'moos']
+    '''
+    if isinstance(node, PSTree):
+      key = (node.span, node.label)
+    else:
+      key = (tuple(node[1:3]), node[0])
+    return self.head_map()[key][1]
+
+  def get_heads(self, nodes):
+    ''' Get the head words of many nodes at once; see get_head '''
+    heads = self.head_map()
+    ans = []
+    for node in nodes:
+      if isinstance(node, PSTree):
+        ans.append(heads[(node.span, node.label)][1])
+      else:
+        ans.append(heads[(tuple(node[1:3]), node[0])][1])
+    return ans
+
+# one match per bracket: an open bracket with its label, then a word and
+# its close bracket if it has them; a lone close bracket; or any other
+# character, which sends tree_from_text to the slow path
+_tree_piece = re.compile(r"\(([^\s()]+)(?:\s+([^\s()]+))?\s*(\)?)|(\))|\S")
+_text_token = re.compile(r"\(|\)|[^()]+")
+_whitespace = re.compile(r"\s")
+
+class SpanIndex:
+  '''Nodes of a tree keyed by span, for get_nodes and get_spanning_nodes.
+
+  Nodes that share a start (or an end) lie on one path from the root, so
+  every list here is in pre-order, which puts the highest node first.'''
+  def __init__(self, root):
+    self.by_span = defaultdict(list)
+    self.by_start = defaultdict(list)
+    self.by_end = defaultdict(list)
+    postorder = []
+    for node in TreeIterator(root, 'post'):
+      postorder.append(node)
+    postorder.reverse()
+    # reverse post-order is the order the tree walk gives for 'all' with
+    # both ends open
+    self.everything = postorder
+    for node in root:
+      self.by_span[node.span].append(node)
+      self.by_start[node.span[0]].append(node)
+      self.by_end[node.span[1]].append(node)
+
+  def _matches(self, start, end):
+    if start < 0 and end < 0:
+      return self.everything
+    elif start < 0:
+      return self.by_end.get(end, ())
+    elif end < 0:
+      return self.by_start.get(start, ())
+    return self.by_span.get((start, end), ())
+
+  def get_nodes(self, request, start=-1, end=-1):
+    matches = self._matches(start, end)
+    if request == 'all':
+      return list(matches)
+    elif len(matches) == 0:
+      return None
+    elif request == 'highest':
+      return matches[0]
+    elif start < 0 and end < 0:
+      raise Exception("Lowest is not well defined when both ends are wildcards")
+    return matches[-1]
+
+  def get_spanning_nodes(self, start, end):
+    ans = []
+    while start < end:
+      for node in self.by_start.get(start, ()):
+        if node.span[1] <= end:
+          break
+      else:
+        return None
+      ans.append(node)
+      start = node.span[1]
+    if start == end:
+      return ans
+    return None
+
+class Yields:
+  '''The terminals of a tree in order, with their words, labels and starts,
+  for word_yield and tag_yield.  The terminals under a node are found from
+  its leftmost and rightmost terminals, and those within a span by bisecting
+  the starts (when they are in order, as calculate_spans leaves them).'''
+  def __init__(self, root):
+    self.terminals = [node for node in root if node.is_terminal()]
+    self.words = [node.word for node in self.terminals]
+    self.tags = [node.label for node in self.terminals]
+    self.starts = [node.span[0] for node in self.terminals]
+    self.position = dict((id(node), i) for (i, node) in enumerate(self.terminals))
+    self.ordered = all(a <= b for (a, b) in zip(self.starts, self.starts[1:]))
+    self.complete = None not in self.words
+
+  def select(self, node, span, field):
+    '''The list of field values of the terminals under node starting within
+    span, skipping those without words.'''
+    (first, last) = (node, node)
+    while len(first.subtrees) > 0:
+      first = first.subtrees[0]
+    while len(last.subtrees) > 0:
+      last = last.subtrees[-1]
+    (i, j) = (self.position[id(first)], self.position[id(last)] + 1)
+    values = getattr(self, field)
+    if span is None:
+      if self.complete:
+        return values[i:j]
+      return [values[k] for k in xrange(i, j) if self.words[k] is not None]
+    if self.ordered:
+      (i, j) = (bisect_left(self.starts, span[0], i, j), bisect_left(self.starts, span[1], i, j))
+      if self.complete:
+        return values[i:j]
+      return [values[k] for k in xrange(i, j) if self.words[k] is not None]
+    return [values[k] for k in xrange(i, j)
+            if self.words[k] is not None and span[0] <= self.starts[k] < span[1]]
+
+def _unshared(string):
+  '''Stand-in for intern, which only takes byte strings.'''
+  return string
 
 def tree_from_text(text, allow_empty_labels=False, allow_empty_words=False, allow_weights=True):
   '''Construct a PSTree from the provided string, which is assumed to represent
   a tree with nested round brackets.  Nodes are labeled by the text between the
   open bracket and the next space (possibly an empty string).  Words are the
-  text after that space and before the close bracket.'''
+  text after that space and before the close bracket.  Any whitespace
+  (including newlines) separates a label from what follows it, so multi-line
+  trees are read the same way as single-line ones.
+
+  Well-formed trees are read with one regular expression match per bracket;
+  text that does not fit that shape (empty labels, words with spaces, stray
+  text, several trees) goes through a slower token-by-token reader, which
+  also raises the errors.
+
+  allow_empty_words is kept only so that existing callers still work and is
+  ignored: a node with no word is read as a phrase, never as an empty word.
+
+  >>> print tree_from_text("(ROOT\\n  (NP (DT the)\\n      (NN cow)))")
+  (ROOT (NP (DT the) (NN cow)))
+  >>> print tree_from_text("(NP 0.25 (NN cow))")
+  (NP (NN cow))
+  >>> print tree_from_text("( (NN cow))", allow_empty_labels=True)
+  ( (NN cow))
+  >>> tree_from_text("(NP cow (NN cow))")
+  Traceback (most recent call last):
+  ...
+  Exception: Stray 'cow' while processing
+  (NP cow (NN cow))
+  '''
+  share = intern if type(text) is str else _unshared
+  root = None
+  cur = None
+  pos = 0
+  for (label, word, close, end) in _tree_piece.findall(text):
+    if label:
+      if cur is None:
+        if root is not None:
+          break
+        root = node = PSTree(None, share(label))
+      else:
+        node = PSTree(None, share(label), (0, 0), cur)
+        cur.subtrees.append(node)
+      if close:
+        if not word:
+          break
+        node.word = share(word)
+        node.span = (pos, pos + 1)
+        pos += 1
+        continue
+      if word and not (allow_weights and jmutil.isFloat(word)):
+        break
+      cur = node
+    elif end and cur is not None and len(cur.subtrees) > 0:
+      cur.span = (cur.subtrees[0].span[0], cur.subtrees[-1].span[1])
+      cur = cur.parent
+    else:
+      break
+  else:
+    if cur is None and root is not None:
+      return root
+  return _tree_from_tokens(text, allow_empty_labels, allow_weights)
+
+def _tree_from_tokens(text, allow_empty_labels, allow_weights):
+  '''The general case of tree_from_text, reading brackets and the runs of
+  text between them one at a time.'''
+  instrument.count('pstree.tree_from_text.slow_path')
+  share = intern if type(text) is str else _unshared
   root = None
   cur = None
   pos = 0
   word = ''
-  for char in text:
+  for token in _text_token.findall(text):
     # Consume random text up to the first '('
     if cur is None:
-      if char == '(':
+      if token == '(':
         root = PSTree()
         cur = root
       continue
 
-    if char == '(':
+    if token == '(':
       word = word.strip()
       if cur.label is DEFAULT_LABEL:
         if len(word) == 0 and not allow_empty_labels:
           raise Exception("Empty label found\n%s" % text)
-        cur.label = word
+        cur.label = share(word)
         word = ''
       if word != '' and not (allow_weights and jmutil.isFloat(word)):
         raise Exception("Stray '%s' while processing\n%s" % (word, text))
-      sub = PSTree()
+      sub = PSTree(parent=cur)
       cur.subtrees.append(sub)
-      sub.parent = cur
       cur = sub
-    elif char == ')':
+    elif token == ')':
       word = word.strip()
       if word != '':
-        if len(word) == 0 and not allow_empty_words:
-          raise Exception("Empty word found\n%s" % text)
-        cur.word = word
-        word = ''
+        cur.word = share(word)
         cur.span = (pos, pos + 1)
         pos += 1
       else:
         cur.span = (cur.subtrees[0].span[0], cur.subtrees[-1].span[1])
+      word = ''
       cur = cur.parent
-    elif char == ' ':
-      if cur.label is DEFAULT_LABEL:
-        if len(word) == 0 and not allow_empty_labels:
-          raise Exception("Empty label found\n%s" % text)
-        cur.label = word
-        word = ''
+    elif cur.label is DEFAULT_LABEL:
+      # The label runs up to the first whitespace; without any whitespace it
+      # is only known once the next bracket is reached
+      match = _whitespace.search(token)
+      if match is None:
+        word = token
       else:
-        word += char
+        if match.start() == 0 and not allow_empty_labels:
+          raise Exception("Empty label found\n%s" % text)
+        cur.label = share(token[:match.start()])
+        word = token[match.end():]
     else:
-      word += char
+      word = token
   if cur is not None:
     raise Exception("Text did not include complete tree\n%s" % text)
   return root
 
 
-def clone_and_find(nodes):
+def _subtree_position(tree, subtree):
+  '''The position of subtree among the subtrees of tree, found by bisecting
+  the starts of their spans rather than scanning from the left.  Falls back
+  to a scan if the spans are out of date.'''
+  subtrees = tree.subtrees
+  start = subtree.span[0]
+  (lo, hi) = (0, len(subtrees))
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if subtrees[mid].span[0] < start:
+      lo = mid + 1
+    else:
+      hi = mid
+  # only subtrees with empty spans share a start
+  while lo < len(subtrees) and subtrees[lo].span[0] == start:
+    if subtrees[lo] is subtree:
+      return lo
+    lo += 1
+  return subtrees.index(subtree)
+
+def clone_and_find(nodes, share=False):
   '''Clone the tree these nodes are in and finds the equivalent nodes in the
-  new tree.'''
+  new tree.  With share, the clone shares its subtrees with the tree (see
+  PSTree.clone) and only the paths down to the nodes are copied, so the
+  nodes returned may be changed in place.
+
+  >>> tree = tree_from_text("(ROOT (S (NP (DT the) (NN cow)) (VP (VBZ moos))))")
+  >>> node = clone_and_find(tree.subtrees[0].subtrees[1], share=True)
+  >>> (node.label, node.root() is tree, node.parent.subtrees[0] is tree.subtrees[0].subtrees[0])
+  ('VP', False, True)
+  '''
   return_list = True
   if type(nodes) != type([]):
     return_list = False
@@ -360,19 +786,23 @@ def clone_and_find(nodes):
   # Note the paths to the nodes
   paths = []
   for node in nodes:
-    paths.append([])
+    path = []
     tree = node
     while tree.parent is not None:
-      prev = tree
+      path.append(_subtree_position(tree.parent, tree))
       tree = tree.parent
-      paths[-1].append(tree.subtrees.index(prev))
+    path.reverse()
+    paths.append(path)
 
   # Duplicate and follow the path back to the equivalent node
-  ntree = nodes[0].root().clone()
+  ntree = nodes[0].root().clone(share)
   ans = []
   for path in paths:
+    if share:
+      ans.append(ntree.edit(path))
+      continue
     tree = ntree
-    for index in path[::-1]:
+    for index in path:
       tree = tree.subtrees[index]
     ans.append(tree)
   if return_list:
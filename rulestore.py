@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+# look rules up in a large isi grammar without reading it all in.
+# one pass over the grammar writes a sidecar index (grammar + '.idx') of
+# rule offsets and hashed keys: TARGET root label, SOURCE signature (the
+# source tokens with each variable written as x) and rule id.  Both files
+# are mmapped, so opening a store is cheap and a lookup only parses the
+# rules it returns.
+# usage:
+#   rulestore.py -i rules.txt                 # build rules.txt.idx
+#   rulestore.py -i rules.txt --root NP       # print the rules rooted in NP,
+#                                             # rebuilding a missing or stale index
+# >>> store = rulestore.RuleStore('rules.txt')
+# >>> [rule.feature('count') for rule in store.by_source('x "cow"')]
+import argparse
+import sys
+import os
+import re
+import mmap
+import struct
+import hashlib
+import numpy
+import binfile
+import sbmt
+
+MAGIC = 'RULESTORE 1\n'
+KINDS = ('root', 'source', 'id')
+
+varre = re.compile(r'x\d+$')
+
+def root_label(target):
+  '''the label at the root of a rule's target tree
+
+  >>> (root_label('NP(x0:DT NN("cow"))'), root_label('x0:NP'))
+  ('NP', 'x0:NP')
+  '''
+  return target.split('(', 1)[0].strip()
+
+def source_signature(source):
+  '''the source tokens with variable numbers dropped, so rules that differ
+  only in how their variables are ordered share a signature
+
+  >>> source_signature(' x1  "the" x0 ')
+  'x "the" x'
+  '''
+  return ' '.join('x' if varre.match(tok) else tok for tok in source.split())
+
+def rule_keys(rule):
+  '''(kind, key) for every index key of an sbmt.Rule'''
+  keys = [('root', root_label(rule.target)), ('source', source_signature(rule.source))]
+  id = rule.feature('id')
+  if id is not None:
+    keys.append(('id', id))
+  return keys
+
+def key_hash(kind, key):
+  '''64-bit hash of an index key, the same on every platform'''
+  return struct.unpack('<Q', hashlib.md5("%s\t%s" % (kind, key)).digest()[:8])[0]
+
+def index_name(rulefile):
+  return rulefile + '.idx'
+
+def build_index(rulefile, indexfile=None):
+  '''Read rulefile once and write its index to indexfile (rulefile.idx by
+  default).  Returns the number of rules.'''
+  if indexfile is None:
+    indexfile = index_name(rulefile)
+  starts = []
+  ends = []
+  hashes = []
+  rules = []
+  pos = 0
+  with open(rulefile, 'rb') as f:
+    for line in f:
+      start = pos
+      pos += len(line)
+      line = line.rstrip("\r\n")
+      if line.strip() == "":
+        continue
+      n = len(starts)
+      starts.append(start)
+      ends.append(start + len(line))
+      for (kind, key) in rule_keys(sbmt.Rule.from_string(line)):
+        hashes.append(key_hash(kind, key))
+        rules.append(n)
+  hashes = numpy.array(hashes, dtype='<u8')
+  rules = numpy.array(rules, dtype='<i8')
+  order = numpy.lexsort((rules, hashes))
+  stat = os.stat(rulefile)
+  binfile.save(indexfile, MAGIC,
+               [('starts', numpy.array(starts, dtype='<i8')), ('ends', numpy.array(ends, dtype='<i8')),
+                ('hashes', hashes[order]), ('rules', rules[order])],
+               {'size': stat.st_size, 'mtime': stat.st_mtime})
+  return len(starts)
+
+class RuleStore:
+  '''
+  Read-only access to the rules of an indexed grammar.  Lookups return
+  sbmt.Rule objects in file order.  The index is built, or rebuilt, when it
+  is missing or the grammar's size or modification time differ from those
+  it was built from.
+
+  >>> import tempfile, shutil
+  >>> dir = tempfile.mkdtemp()
+  >>> rulefile = os.path.join(dir, 'rules')
+  >>> lines = ['NP(x0:DT NN("cow")) -> x0 "cow" ### id=1 lm=-2',
+  ...          'NP(x0:DT NN("cows")) -> x0 "cows" ### id=2',
+  ...          'VP(VBZ("moos")) -> "moos" ### id=3 lm=-1',
+  ...          'SQ(x0:NP x1:VP) -> x0 x1 ### id=4',
+  ...          'NP(x0:NN x1:PP) -> x1 x0 ### id=5']
+  >>> with open(rulefile, 'w') as f:
+  ...   f.write('\\n'.join(lines[:4]) + '\\n')
+  >>> build_index(rulefile)
+  4
+  >>> store = RuleStore(rulefile)
+  >>> (len(store), str(store.rule(2)) == lines[2])
+  (4, True)
+  >>> [r.feature('id') for r in store.by_root('NP')]
+  ['1', '2']
+  >>> [r.feature('id') for r in store.by_source('x9 "cow"')]
+  ['1']
+  >>> ([str(r) for r in store.by_id(4)] == [lines[3]], store.by_root('PP'), store.by_id('-1'))
+  (True, [], [])
+  >>> store.close()
+
+  Replacing a rule with one of the same length leaves the size alone, but
+  not the modification time:
+  >>> mtime = os.stat(rulefile).st_mtime
+  >>> with open(rulefile, 'w') as f:
+  ...   f.write('\\n'.join(lines[:3] + lines[4:]) + '\\n')
+  >>> os.utime(rulefile, (mtime + 1, mtime + 1))
+  >>> store = RuleStore(rulefile)
+  >>> [r.feature('id') for r in store.by_root('NP')]
+  ['1', '2', '5']
+  >>> store.close(); shutil.rmtree(dir)
+  '''
+  def __init__(self, rulefile, indexfile=None):
+    if indexfile is None:
+      indexfile = index_name(rulefile)
+    stat = os.stat(rulefile)
+    if not os.path.exists(indexfile):
+      build_index(rulefile, indexfile)
+    (arrays, meta) = binfile.load(indexfile, MAGIC)
+    if stat.st_size != meta['size'] or stat.st_mtime != meta['mtime']:
+      build_index(rulefile, indexfile)
+      (arrays, meta) = binfile.load(indexfile, MAGIC)
+    self.starts = arrays['starts']
+    self.ends = arrays['ends']
+    self.hashes = arrays['hashes']
+    self.rules = arrays['rules']
+    with open(rulefile, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if meta['size'] > 0 else ''
+
+  def __len__(self):
+    return len(self.starts)
+
+  def rule(self, n):
+    '''the n-th rule of the file, blank lines not counted'''
+    return sbmt.Rule.from_string(self.data[int(self.starts[n]):int(self.ends[n])])
+
+  def __iter__(self):
+    for n in xrange(len(self)):
+      yield self.rule(n)
+
+  def lookup(self, kind, key):
+    '''the rules with the given key, kind being one of KINDS'''
+    if kind not in KINDS:
+      raise Exception("%s is not one of %s" % (str(kind), ', '.join(KINDS)))
+    h = numpy.uint64(key_hash(kind, key))
+    lo = numpy.searchsorted(self.hashes, h, 'left')
+    hi = numpy.searchsorted(self.hashes, h, 'right')
+    found = []
+    for n in self.rules[lo:hi]:
+      rule = self.rule(n)
+      # different keys can share a hash
+      if (kind, key) in rule_keys(rule):
+        found.append(rule)
+    return found
+
+  def by_root(self, label):
+    return self.lookup('root', label)
+
+  def by_source(self, source):
+    '''rules whose source matches source once variable numbers are dropped'''
+    return self.lookup('source', source_signature(source))
+
+  def by_id(self, id):
+    return self.lookup('id', str(id))
+
+  def close(self):
+    if isinstance(self.data, mmap.mmap):
+      self.data.close()
+
+def main():
+  parser = argparse.ArgumentParser(description="build a sidecar index for an isi rule file, or look rules up in it")
+  parser.add_argument("--infile", "-i", required=True, help="rule file")
+  parser.add_argument("--index", "-x", default=None, help="index file (default: rule file + .idx)")
+  parser.add_argument("--root", "-r", default=None, help="print the rules whose target has this root label")
+  parser.add_argument("--source", "-s", default=None, help="print the rules with this source signature")
+  parser.add_argument("--id", default=None, help="print the rule with this id")
+  parser.add_argument("--outfile", "-o", nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="output file")
+
+  try:
+    args = parser.parse_args()
+  except IOError, msg:
+    parser.error(str(msg))
+
+  queries = [(kind, key) for (kind, key) in zip(KINDS, (args.root, args.source, args.id)) if key is not None]
+  if len(queries) == 0:
+    count = build_index(args.infile, args.index)
+    sys.stderr.write("indexed %d rules\n" % count)
+    return
+  store = RuleStore(args.infile, args.index)
+  for (kind, key) in queries:
+    if kind == 'source':
+      key = source_signature(key)
+    for rule in store.lookup(kind, key):
+      args.outfile.write("%s\n" % rule)
+
+if __name__ == '__main__':
+  main()
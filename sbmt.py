@@ -2,7 +2,11 @@
 import argparse
 import sys
 import re
+from itertools import islice
+import numpy
+import jmutil
 import tree
+import pipeline
 
 # class ParseError(Exception):
 #   ''' print out context and point of error in context '''
@@ -22,17 +26,20 @@ import tree
 #       ctxt=ctxt+"\n"+self.ctxt+"\n"+(" "*self.point)+"^"+(" "*rem)
 #     return ctxt
 
+entryre=re.compile(r"\s*(\S+)=((?:[^\s{}]+)|(?:{{{[^\}]*}}}))\s*")
+# one value of an entry, for Rule.feature
+featvalre=re.compile(r"(?:[^\s{}]+)|(?:{{{[^\}]*}}})")
+
 def parse_feat_string(string):
   '''
   given an isi-style string of space separated key=val pairs and key={{{entry with spaces}}} pairs, return
   a dict of those entries. meant to be used by various flavors, i.e. nbest list, rule
+
+  >>> sorted(parse_feat_string("a=1 b={{{x y}}} a=2").items())
+  [('a', '2'), ('b', '{{{x y}}}')]
   '''
-  feats={}
-  spos=0
-  entryre=re.compile(r"\s*(\S+)=((?:[^\s{}]+)|(?:{{{[^\}]*}}}))\s*")
-  for match in entryre.findall(string):
-    feats[match[0]]=match[1]
-  return feats
+  # later entries win, as when the dict was filled one match at a time
+  return dict(entryre.findall(string))
 
 
 def parse_nbest(string):
@@ -44,6 +51,158 @@ def parse_nbest(string):
     raise Exception("String should start with NBEST but starts with "+fields[0])
   return parse_feat_string(' '.join(fields[1:]))
 
+class NbestList:
+  '''
+  the hypotheses of one sentence of an n-best list. sent is the sentence
+  id; features is the jmutil.Vocab of feature names, shared by every
+  sentence read from one file; matrix is a float array with a row per
+  hypothesis and a column per feature known when the sentence was read
+  (0.0 where a hypothesis lacks one); strings is a dict per hypothesis of
+  the fields that are not numbers, such as hyp and derivation
+  '''
+  def __init__(self, sent, features, matrix, strings):
+    self.sent = sent
+    self.features = features
+    self.matrix = matrix
+    self.strings = strings
+
+  def __len__(self):
+    return len(self.strings)
+
+  def column(self, name):
+    '''
+    the values of one feature for every hypothesis
+    '''
+    i = self.features.get(name)
+    if i < 0 or i >= self.matrix.shape[1]:
+      return numpy.zeros(len(self))
+    return self.matrix[:, i]
+
+  def scores(self, weights):
+    '''
+    the dot product of every hypothesis with weights, either a dict from
+    feature name to weight or an array indexed by feature id
+    '''
+    if isinstance(weights, dict):
+      weights = weight_vector(self.features, weights)
+    columns = self.matrix.shape[1]
+    if len(weights) < columns:
+      raise Exception("%d weights for %d features" % (len(weights), columns))
+    return self.matrix.dot(weights[:columns])
+
+def weight_vector(features, weights):
+  '''
+  a float array over the ids of the jmutil.Vocab features from a dict of
+  weights by name; names the vocab does not know are ignored
+  '''
+  vector = numpy.zeros(len(features))
+  for (name, weight) in weights.iteritems():
+    i = features.get(name)
+    if i >= 0:
+      vector[i] = float(weight)
+  return vector
+
+def _numeric_fields(entries, features, text_fields, columns, values, skip=None):
+  '''
+  append the feature id and float value of each (name, value) entry that is
+  a number to columns and values, adding new names to features, and return
+  a dict of the rest. names whose values have not parsed as floats before
+  are in text_fields and are not tried again. a name that has had numeric
+  values (or that features already holds) must keep them, so that no field
+  is split between the numbers and the strings
+
+  >>> (features, columns, values) = (jmutil.Vocab(), [], [])
+  >>> _numeric_fields([('lm', '-2'), ('hyp', '{{{a}}}')], features, set(), columns, values)
+  {'hyp': '{{{a}}}'}
+  >>> _numeric_fields([('lm', 'high')], features, set(), columns, values)
+  Traceback (most recent call last):
+  ...
+  Exception: lm=high is not a number, but lm has had numeric values
+  '''
+  ids = features.ids
+  text = {}
+  for (name, value) in entries:
+    if name == skip:
+      continue
+    if name not in text_fields:
+      try:
+        value = float(value)
+      except ValueError:
+        if name in ids:
+          raise Exception("%s=%s is not a number, but %s has had numeric values" % (name, value, name))
+        text_fields.add(name)
+      else:
+        try:
+          columns.append(ids[name])
+        except KeyError:
+          columns.append(features.id(name))
+        values.append(value)
+        continue
+    text[name] = value
+  return text
+
+def read_nbest(fh, features=None, key='sent'):
+  '''
+  yield an NbestList for each sentence of an isi-style n-best file, whose
+  hypotheses are on consecutive lines with the same value of the key field.
+  fields whose values parse as floats go into the matrix (a later value of
+  one that does not is an error), the key becomes sent and the rest are
+  kept as strings. features, a
+  jmutil.Vocab, can be passed in to fix the columns of known feature names
+
+  >>> from StringIO import StringIO
+  >>> text = ("NBEST sent=1 nbest=0 totalcost=4.5 hyp={{{the cow}}} lm=-2 tm=-1.5\\n"
+  ...         "NBEST sent=1 nbest=1 totalcost=5 hyp={{{a cow}}} lm=-3\\n"
+  ...         "NBEST sent=2 nbest=0 totalcost=1 hyp={{{moo}}} tm=-0.5 count=2\\n")
+  >>> lists = list(read_nbest(StringIO(text)))
+  >>> [(nbest.sent, len(nbest)) for nbest in lists]
+  [('1', 2), ('2', 1)]
+  >>> lists[0].features.strings
+  ['nbest', 'totalcost', 'lm', 'tm', 'count']
+  >>> lists[0].matrix.tolist()
+  [[0.0, 4.5, -2.0, -1.5], [1.0, 5.0, -3.0, 0.0]]
+  >>> (lists[0].strings[1]['hyp'], lists[1].column('count').tolist())
+  ('{{{a cow}}}', [2.0])
+  >>> lists[0].scores({'lm': 1, 'tm': 2}).tolist()
+  [-5.0, -3.0]
+  '''
+  if features is None:
+    features = jmutil.Vocab()
+  text_fields = set()
+  sent = None
+  rows = []
+  columns = []
+  values = []
+  strings = []
+  def block():
+    matrix = numpy.zeros((len(strings), len(features)))
+    matrix[rows, columns] = values
+    return NbestList(sent, features, matrix, strings)
+  for line in fh:
+    if line.strip() == "":
+      continue
+    if not line.startswith("NBEST"):
+      raise Exception("String should start with NBEST but starts with "+line.split()[0])
+    entries = entryre.findall(line, 5)
+    this = None
+    for (name, value) in entries:
+      if name == key:
+        this = value
+        break
+    if len(strings) == 0 or this != sent:
+      if len(strings) > 0:
+        yield block()
+      sent = this
+      rows = []
+      columns = []
+      values = []
+      strings = []
+    before = len(columns)
+    strings.append(_numeric_fields(entries, features, text_fields, columns, values, key))
+    rows.extend([len(strings) - 1] * (len(columns) - before))
+  if len(strings) > 0:
+    yield block()
+
 def parse_rule(string):
   '''
   given an isi syntax rule, return the feature dictionary including "SOURCE" and "TARGET"
@@ -58,26 +217,462 @@ def parse_rule(string):
   except Exception as e:
     raise Exception("could not parse "+string, e)
 
+class Rule(object):
+  '''
+  an isi syntax rule whose features are only decoded when one is asked for.
+  Indexing it by name works like the dict from parse_rule.
+
+  >>> rule = Rule.from_string('NP(x0:DT NN("cow")) -> x0 "cow" ### id=7 lm=-2.5 headmarker={{{R(DH)}}}')
+  >>> (rule.target, rule.source, rule['SOURCE'], rule.feature('lm'), rule.feature('tm', '0'))
+  ('NP(x0:DT NN("cow"))', 'x0 "cow"', 'x0 "cow"', '-2.5', '0')
+  >>> rule.to_dict() == parse_rule(str(rule))
+  True
+  '''
+  __slots__ = ('target', 'source', 'feat_string', '_feats')
+
+  def __init__(self, target, source, feat_string):
+    self.target = target
+    self.source = source
+    self.feat_string = feat_string
+    self._feats = None
+
+  @staticmethod
+  def from_string(string):
+    '''
+    split an isi syntax rule into target, source and undecoded features
+    '''
+    try:
+      (rule, rest) = string.split(" ### ")
+      (target, source) = rule.split(" -> ")
+      return Rule(target, source, rest)
+    except Exception as e:
+      raise Exception("could not parse "+string, e)
+
+  def features(self):
+    '''
+    the dict of all features (not including SOURCE and TARGET), decoded once
+    '''
+    if self._feats is None:
+      self._feats = parse_feat_string(self.feat_string)
+    return self._feats
+
+  def feature(self, name, default=None):
+    '''
+    the raw string value of one feature, or default, as features() would
+    give it. only the entry asked for is scanned out, from the end since
+    later entries win, so nothing else is decoded. words inside a {{{...}}}
+    value are never entries here, even the first one (which
+    parse_feat_string splits at its last = when it has one)
+
+    >>> rule = Rule.from_string('A(x0:B) -> x0 ### align={{{lm=9 x}}} lm=-1 tm={{{a b}}} lm=-2.5')
+    >>> (rule.feature('lm'), rule.feature('tm'), rule.feature('m'), rule._feats)
+    ('-2.5', '{{{a b}}}', None, None)
+    '''
+    if self._feats is not None:
+      return self._feats.get(name, default)
+    string = self.feat_string
+    key = name + "="
+    i = string.rfind(key)
+    while i >= 0:
+      # the name must start an entry, outside any {{{...}}} value
+      if ((i == 0 or string[i - 1].isspace() or string.endswith("}}}", 0, i)) and
+          string.count("{{{", 0, i) == string.count("}}}", 0, i)):
+        match = featvalre.match(string, i + len(key))
+        # an = in a bare value means the entry's name is longer than ours
+        if match is not None and (match.group()[0] == "{" or "=" not in match.group()):
+          return match.group()
+      i = string.rfind(key, 0, i)
+    return default
+
+  def __getitem__(self, name):
+    if name == 'SOURCE':
+      return self.source
+    if name == 'TARGET':
+      return self.target
+    return self.features()[name]
+
+  def __contains__(self, name):
+    return name in ('SOURCE', 'TARGET') or self.feature(name) is not None
+
+  def get(self, name, default=None):
+    if name in ('SOURCE', 'TARGET'):
+      return self[name]
+    return self.feature(name, default)
+
+  def to_dict(self):
+    '''
+    the same dict parse_rule gives
+    '''
+    feats = dict(self.features())
+    feats['SOURCE'] = self.source
+    feats['TARGET'] = self.target
+    return feats
+
+  def __str__(self):
+    return "%s -> %s ### %s" % (self.target, self.source, self.feat_string)
+
+def read_rules(fh):
+  '''
+  yield a Rule for every non-blank line of a rule file
+
+  >>> from StringIO import StringIO
+  >>> [rule.target for rule in read_rules(StringIO('A(x0:B) -> x0 ### id=1\\n\\nB("b") -> "b" ### id=2\\n'))]
+  ['A(x0:B)', 'B("b")']
+  '''
+  for line in fh:
+    line = line.rstrip("\r\n")
+    if line.strip() == "":
+      continue
+    yield Rule.from_string(line)
+
+class RuleTask:
+  '''
+  picklable wrapper that parses a rule line and applies func to the Rule
+  '''
+  def __init__(self, func):
+    self.func = func
+
+  def __call__(self, line):
+    return self.func(Rule.from_string(line.rstrip("\r\n")))
+
+def map_rules(func, fh, workers=None, chunksize=1000):
+  '''
+  yield func(rule) for every rule in a rule file, in file order, parsing and
+  applying func in worker processes with pipeline.ordered_map. func must be
+  picklable, i.e. defined at module level. workers=1 stays in this process.
+  '''
+  lines = (line for line in fh if line.strip() != "")
+  return pipeline.ordered_map(RuleTask(func), lines, workers, chunksize)
+
+class RuleFeatures:
+  '''
+  the numeric features of a batch of rules as CSR-style arrays: the
+  features of rule i have ids indices[indptr[i]:indptr[i+1]] in the
+  jmutil.Vocab features, shared by every batch of a grammar, and float
+  values values[indptr[i]:indptr[i+1]]
+
+  >>> batch = rule_features(['A(x0:B) -> x0 ### id=1 lm=-2 tm=-1 headmarker={{{R(H)}}}',
+  ...                        'B("b") -> "b" ### id=2 count=3 lm=-0.5'])
+  >>> (len(batch), batch.features.strings, batch.indptr.tolist(), batch.indices.tolist())
+  (2, ['id', 'lm', 'tm', 'count'], [0, 3, 6], [0, 1, 2, 0, 3, 1])
+  >>> batch.dot({'lm': 1.0, 'count': 0.5}).tolist()
+  [-2.0, 1.0]
+  >>> (batch.column('tm').tolist(), sorted(batch.row(1).items()))
+  ([-1.0, 0.0], [('count', 3.0), ('id', 2.0), ('lm', -0.5)])
+  '''
+  def __init__(self, features, indptr, indices, values):
+    self.features = features
+    self.indptr = indptr
+    self.indices = indices
+    self.values = values
+
+  def __len__(self):
+    return len(self.indptr) - 1
+
+  def row_ids(self):
+    '''
+    the rule number of every stored value
+    '''
+    return numpy.repeat(numpy.arange(len(self)), numpy.diff(self.indptr))
+
+  def row(self, i):
+    '''
+    the features of rule i as a dict
+    '''
+    (a, b) = (self.indptr[i], self.indptr[i + 1])
+    return dict((self.features.string(j), v) for (j, v) in zip(self.indices[a:b].tolist(), self.values[a:b].tolist()))
+
+  def column(self, name):
+    '''
+    the value of one feature for every rule, 0.0 where it is missing
+    '''
+    column = numpy.zeros(len(self))
+    mask = self.indices == self.features.get(name)
+    column[self.row_ids()[mask]] = self.values[mask]
+    return column
+
+  def dot(self, weights):
+    '''
+    the dot product of every rule with weights, either a dict from feature
+    name to weight or an array indexed by feature id
+    '''
+    if isinstance(weights, dict):
+      weights = weight_vector(self.features, weights)
+    if len(weights) < len(self.features):
+      weights = numpy.concatenate((weights, numpy.zeros(len(self.features) - len(weights))))
+    return numpy.bincount(self.row_ids(), weights=weights[self.indices] * self.values, minlength=len(self))
+
+def rule_features(rules, features=None, text_fields=None):
+  '''
+  a RuleFeatures of the numeric features of rules, given as strings or
+  Rules. features and text_fields (the set of names whose values are not
+  numbers) are carried from batch to batch by read_rule_features
+  '''
+  if features is None:
+    features = jmutil.Vocab()
+  if text_fields is None:
+    text_fields = set()
+  indptr = [0]
+  columns = []
+  values = []
+  for rule in rules:
+    if isinstance(rule, Rule):
+      feat_string = rule.feat_string
+    else:
+      (rule, sep, feat_string) = rule.partition(" ### ")
+      if sep == "":
+        raise Exception("could not parse "+rule)
+    _numeric_fields(entryre.findall(feat_string), features, text_fields, columns, values)
+    indptr.append(len(columns))
+  return RuleFeatures(features, numpy.array(indptr, dtype=numpy.int64),
+                      numpy.array(columns, dtype=numpy.int32), numpy.array(values, dtype=numpy.float64))
+
+def read_rule_features(fh, features=None, batch=100000):
+  '''
+  yield a RuleFeatures for every batch rules of a rule file, all sharing
+  one feature vocabulary
+  '''
+  if features is None:
+    features = jmutil.Vocab()
+  text_fields = set()
+  lines = (line for line in fh if line.strip() != "")
+  while True:
+    chunk = list(islice(lines, batch))
+    if len(chunk) == 0:
+      break
+    yield rule_features(chunk, features, text_fields)
+
+class FeatureStats:
+  '''
+  count, total, min and max of every feature over a stream of
+  RuleFeatures batches, as arrays indexed by feature id
+
+  >>> from StringIO import StringIO
+  >>> text = 'A(x0:B) -> x0 ### lm=-2 tm=-1\\nB("b") -> "b" ### count=3 lm=-0.5\\nC("c") -> "c" ### lm=1\\n'
+  >>> stats = FeatureStats()
+  >>> for batch in read_rule_features(StringIO(text), batch=2):
+  ...   stats.add(batch)
+  >>> sorted(stats.summary().items())
+  [('count', (1, 3.0, 3.0, 3.0)), ('lm', (3, -1.5, -2.0, 1.0)), ('tm', (1, -1.0, -1.0, -1.0))]
+  '''
+  def __init__(self):
+    self.features = None
+    self.count = numpy.zeros(0, dtype=numpy.int64)
+    self.total = numpy.zeros(0)
+    self.min = numpy.zeros(0)
+    self.max = numpy.zeros(0)
+
+  def _grow(self, size):
+    extra = size - len(self.count)
+    if extra > 0:
+      self.count = numpy.concatenate((self.count, numpy.zeros(extra, dtype=numpy.int64)))
+      self.total = numpy.concatenate((self.total, numpy.zeros(extra)))
+      self.min = numpy.concatenate((self.min, numpy.repeat(numpy.inf, extra)))
+      self.max = numpy.concatenate((self.max, numpy.repeat(-numpy.inf, extra)))
+
+  def add(self, batch):
+    if self.features is None:
+      self.features = batch.features
+    elif self.features is not batch.features:
+      raise Exception("batches must share one feature vocabulary")
+    size = len(batch.features)
+    self._grow(size)
+    self.count[:size] += numpy.bincount(batch.indices, minlength=size)
+    self.total[:size] += numpy.bincount(batch.indices, weights=batch.values, minlength=size)
+    numpy.minimum.at(self.min, batch.indices, batch.values)
+    numpy.maximum.at(self.max, batch.indices, batch.values)
+
+  def summary(self):
+    '''
+    dict from feature name to (count, total, min, max)
+    '''
+    if self.features is None:
+      return {}
+    return dict((self.features.string(i), (int(self.count[i]), float(self.total[i]), float(self.min[i]), float(self.max[i])))
+                for i in xrange(len(self.count)) if self.count[i] > 0)
+
+# a variable: xN:LABEL as a target leaf or xN on the source side
+varscan = re.compile(r'(?<![^\s(])x(\d+)(?::([^\s()]*))?(?=[\s)]|$)')
+
+def rule_variables(string):
+  '''
+  the variables of an isi rule given as a string: (source order, labels),
+  where source order lists the variable numbers in the order they appear
+  in the source and labels[n] is the target label of xn (None for a bare
+  xn:). one compiled scan over each side of the rule
+
+  >>> rule_variables('S(x0:NP VP(x1:VBZ NN("x2")) x2:) -> x2 "x" x1 x0 ### id=1')
+  ([2, 1, 0], ['NP', 'VBZ', None])
+  '''
+  arrow = string.find(" -> ")
+  end = string.find(" ### ", arrow)
+  if arrow < 0 or end < 0:
+    raise Exception("could not parse "+string)
+  target = [(int(number), label) for (number, label) in varscan.findall(string, 0, arrow)]
+  order = [int(number) for (number, label) in varscan.findall(string, arrow + 4, end)]
+  numbers = range(len(target))
+  if sorted(number for (number, label) in target) != numbers or sorted(order) != numbers:
+    raise Exception("variables don't match or aren't numbered from x0 in "+string)
+  labels = [None] * len(target)
+  for (number, label) in target:
+    labels[number] = label if label != "" else None
+  return (order, labels)
+
+class VariableAlignments:
+  '''
+  the variables of a batch of rules as CSR-style arrays: rule i has
+  indptr[i+1] - indptr[i] variables, order[indptr[i]:indptr[i+1]] is the
+  permutation taking source positions to target variable numbers and
+  label_ids[indptr[i]:indptr[i+1]] are the ids of the target labels of
+  x0, x1, ... in the jmutil.Vocab labels, shared by every batch of a
+  grammar (-1 for no label)
+
+  >>> batch = variable_alignments(['S(x0:NP x1:VP) -> x1 x0 ### id=1',
+  ...                              'NP(x0:DT x1:JJ x2:NN) -> x0 x2 "de" x1 ### id=2',
+  ...                              'NN("cow") -> "vache" ### id=3'])
+  >>> (batch.arity().tolist(), batch.order.tolist(), batch.labels.strings)
+  ([2, 3, 0], [1, 0, 0, 2, 1], ['NP', 'VP', 'DT', 'JJ', 'NN'])
+  >>> (batch.permutation(1), batch.crossings().tolist())
+  ([0, 2, 1], [1, 1, 0])
+  >>> batch.histogram().tolist()
+  [[1, 0], [0, 0], [0, 1], [0, 1]]
+  '''
+  def __init__(self, labels, indptr, order, label_ids):
+    self.labels = labels
+    self.indptr = indptr
+    self.order = order
+    self.label_ids = label_ids
+
+  def __len__(self):
+    return len(self.indptr) - 1
+
+  def arity(self):
+    '''
+    the number of variables of every rule
+    '''
+    return numpy.diff(self.indptr)
+
+  def permutation(self, i):
+    return self.order[self.indptr[i]:self.indptr[i + 1]].tolist()
+
+  def crossings(self):
+    '''
+    the number of pairs of variables whose order the source and target
+    disagree on, for every rule; 0 for monotone rules
+    '''
+    arity = self.arity()
+    crossings = numpy.zeros(len(self), dtype=numpy.int64)
+    if len(self.order) == 0:
+      return crossings
+    rows = numpy.repeat(numpy.arange(len(self)), arity)
+    ends = numpy.repeat(self.indptr[1:], arity)
+    positions = numpy.arange(len(self.order))
+    # compare every variable with the one d places on in the same rule
+    for d in xrange(1, int(arity.max())):
+      first = positions[positions + d < ends]
+      crossed = self.order[first] > self.order[first + d]
+      crossings += numpy.bincount(rows[first[crossed]], minlength=len(self))
+    return crossings
+
+  def histogram(self):
+    '''
+    counts of rules by number of variables (rows) and crossings (columns)
+    '''
+    arity = self.arity()
+    crossings = self.crossings()
+    if len(self) == 0:
+      return numpy.zeros((1, 1), dtype=numpy.int64)
+    width = int(crossings.max()) + 1
+    height = int(arity.max()) + 1
+    return numpy.bincount(arity * width + crossings, minlength=width * height).reshape(height, width)
+
+def variable_alignments(rules, labels=None):
+  '''
+  a VariableAlignments of rules given as strings
+  '''
+  if labels is None:
+    labels = jmutil.Vocab()
+  indptr = [0]
+  order = []
+  label_ids = []
+  for rule in rules:
+    (source, names) = rule_variables(rule)
+    order.extend(source)
+    label_ids.extend([labels.id(name) if name is not None else -1 for name in names])
+    indptr.append(len(order))
+  return VariableAlignments(labels, numpy.array(indptr, dtype=numpy.int64),
+                            numpy.array(order, dtype=numpy.int32), numpy.array(label_ids, dtype=numpy.int32))
+
+def read_variable_alignments(fh, labels=None, batch=100000):
+  '''
+  yield a VariableAlignments for every batch rules of a rule file, all
+  sharing one label vocabulary
+  '''
+  if labels is None:
+    labels = jmutil.Vocab()
+  lines = (line.rstrip("\r\n") for line in fh if line.strip() != "")
+  while True:
+    chunk = list(islice(lines, batch))
+    if len(chunk) == 0:
+      break
+    yield variable_alignments(chunk, labels)
+
+rule_tree_tokenizer = re.compile(r'"\("|"\)"|[^\s()]+\(|[^\s()]+|\(|\)')
+
 def parse_rule_tree(string):
   '''
   given a paren-safe a(b c(d e)) tree, return a chiang tree
-  input can have "(" or ")" quoted lexical items but trickier stuff will bomb out
-  '''
-  string = re.sub(r'"\("', r'"-LRBJM-"', string)
-  string = re.sub(r'"\)"', r'"-RRBJM-"', string)
-  string = re.sub('\(', r' ( ', string).split(' ')
-#  print string
-  for idx, tok in enumerate(string):
-    if tok == "(":
-      string[idx-1], string[idx] = string[idx], string[idx-1]
-#  print ' '.join(string)
-  ptree = tree.str_to_tree(' '.join(string))
-  for node in ptree.frontier():
-    if node.label == '"-LRBJM-"':
-      node.label = '"("'
-    if node.label == '"-RRBJM-"':
-      node.label = '")"'
-  return ptree
+  input can have "(" or ")" quoted lexical items and variables like x0:NNP
+  as leaves; anything else that isn't a well-formed tree raises an Exception
+
+  >>> print parse_rule_tree('NP(x0:DT NN("(") NNS("cows" ")"))')
+  (NP x0:DT (NN "(") (NNS "cows" ")"))
+  >>> t = parse_rule_tree('S(x0:NP VP(x1:VBZ x2:NP))')
+  >>> (t.length, t.children[1].label, t.children[1].children[1].parent.label, t.children[1].order)
+  (3, 'VP', 'VP', 1)
+  >>> print parse_rule_tree('x0:NP')
+  x0:NP
+  '''
+  share = type(string) is str
+  root = None
+  top = None
+  stack = []
+  for token in rule_tree_tokenizer.findall(string):
+    if token == ")":
+      if top is None:
+        raise Exception("unbalanced ) in rule tree "+string)
+      node = stack.pop()
+      if node.length == 0:
+        node.length = 1
+      if len(stack) > 0:
+        top = stack[-1]
+        top.length += node.length
+      else:
+        top = None
+      continue
+    if root is not None and top is None:
+      raise Exception("more than one tree in "+string)
+    if token == "(":
+      raise Exception("( without a label in rule tree "+string)
+    opens = token[-1] == "(" and token != '"("'
+    label = token[:-1] if opens else token
+    node = tree.Node(intern(label) if share else label)
+    if top is None:
+      root = node
+    else:
+      node.parent = top
+      node.order = len(top.children)
+      top.children.append(node)
+    if opens:
+      # lengths are summed from the children when the node is closed
+      node.length = 0
+      stack.append(node)
+      top = node
+    elif top is not None:
+      top.length += 1
+  if root is None or len(stack) > 0:
+    raise Exception("incomplete rule tree "+string)
+  return root
 
 def get_var_position(string):
   '''
@@ -112,8 +707,8 @@ def target_order_map(string):
 
 
 def clean_heads(tree):
-  if 'head' in tree.__dict__:
-    foo=tree.__dict__.pop('head')
+  if hasattr(tree, 'head'):
+    del tree.head
   newchildren=[]
   for c in tree.children:
     newchildren.append(clean_heads(c))
@@ -123,15 +718,137 @@ def clean_heads(tree):
 
 def head_annotate_tree_from_rule(rule, local=True):
   ''' assume headmarker and TARGET field. create a target tree and annotate with heads.
-      if local, local relative. if not, global to root relative '''
+      if local, local relative. if not, global to root relative
+
+  >>> rule = parse_rule('S(x0:NP VP(VBZ("moos") x1:ADVP)) -> x0 "moo" x1 ### headmarker={{{R(D H(HD))}}}')
+  >>> [(node.label, node.head) for node in head_annotate_tree_from_rule(rule).traversal() if hasattr(node, 'head')]
+  [('x0:NP', False), ('VP', True), ('VBZ', True), ('"moos"', True), ('x1:ADVP', False)]
+  '''
   target = parse_rule_tree(rule['TARGET'].strip())
-  # head tree is compressed; open it up, but remove whitespace before open paren
-  head_tree_text = ' '.join(list(rule['headmarker'].strip('{}').strip()))
-  head_tree_text = re.sub(r' +\(', r'(', head_tree_text)
-  heads = parse_rule_tree(head_tree_text)
-  target = head_annotate_tree(heads, target, relative=None if local else target)
+  set_head_flags(target, rule_head_flags(rule, local))
   return target
 
+head_tokenizer = re.compile(r'[^()]\(?|\)|\(')
+
+def _tree_shape(tokens, string):
+  '''
+  the list of children of every node, in pre-order, of a tree in a(b c)
+  notation given as tokens, a label joined to its ( opening a node
+  '''
+  children = []
+  stack = []
+  for token in tokens:
+    if token == ")":
+      if len(stack) == 0:
+        raise Exception("unbalanced ) in rule tree "+string)
+      stack.pop()
+      continue
+    if len(children) > 0 and len(stack) == 0:
+      raise Exception("more than one tree in "+string)
+    if token == "(":
+      raise Exception("( without a label in rule tree "+string)
+    n = len(children)
+    if len(stack) > 0:
+      children[stack[-1]].append(n)
+    children.append([])
+    if token[-1] == "(" and token != '"("':
+      stack.append(n)
+  if len(children) == 0 or len(stack) > 0:
+    raise Exception("incomplete rule tree "+string)
+  return children
+
+def head_flags(target, headmarker, local=True):
+  '''
+  the head flags head_annotate_tree gives the nodes of the target tree of a
+  rule, as a bytearray over the nodes in pre-order (the order of
+  tree.Node.traversal): 1 for a head, 0 for not, and 2 for unmarked, which
+  is only the root of a tree bigger than a preterminal. if local, a node is
+  flagged as the head of its parent; if not, only the nodes on the head
+  path from the root are. neither tree is built
+
+  >>> list(head_flags('S(x0:NP VP(VBZ("moos") x1:ADVP))', '{{{R(D H(HD))}}}'))
+  [2, 0, 1, 1, 1, 0]
+  >>> list(head_flags('S(x0:NP VP(VBZ("moos") x1:ADVP))', 'R(H D(HD))', local=False))
+  [2, 1, 0, 0, 0, 0]
+  '''
+  children = _tree_shape(rule_tree_tokenizer.findall(target), target)
+  head_tokens = head_tokenizer.findall(''.join(headmarker.strip('{}').split()))
+  head_children = _tree_shape(head_tokens, headmarker)
+  heads = [token[0] == 'H' for token in head_tokens if token != ')']
+  if head_tokens[0][0] != 'R':
+    raise Exception("Expected root of heads tree to be 'R'")
+  flags = bytearray([2]) * len(children)
+  kids = children[0]
+  if len(kids) == 0 or (len(kids) == 1 and len(children[kids[0]]) == 0):
+    # special case: single node
+    flags[0] = 1
+    if len(kids) == 1:
+      flags[kids[0]] = 1
+    return flags
+  stack = [(0, 0)]
+  while len(stack) > 0:
+    (node, head) = stack.pop()
+    kids = children[node]
+    if len(kids) == 0:
+      continue
+    flag = flags[node]
+    if len(kids) == 1 and len(children[kids[0]]) == 0:
+      # preterminal: the word goes with its tag
+      if flag != 2:
+        flags[kids[0]] = flag
+      continue
+    head_kids = head_children[head]
+    if len(kids) != len(head_kids):
+      raise Exception("Heads tree doesn't match target: "+headmarker+" vs "+target)
+    if local or node == 0 or flag == 1:
+      for (kid, head_kid) in zip(kids, head_kids):
+        flags[kid] = heads[head_kid]
+    elif flag == 0:
+      for kid in kids:
+        flags[kid] = 0
+    stack.extend(zip(kids, head_kids))
+  return flags
+
+def rule_head_flags(rule, local=True):
+  '''
+  head_flags of a rule, anything with TARGET and headmarker fields
+  '''
+  return head_flags(rule['TARGET'].strip(), rule['headmarker'], local)
+
+def set_head_flags(tree, flags):
+  '''
+  set the head attribute of the nodes of tree from flags in pre-order, as
+  head_annotate_tree would, without rebuilding any children lists
+  '''
+  for (node, flag) in zip(tree.traversal(), flags):
+    if flag != 2:
+      node.head = flag == 1
+    elif hasattr(node, 'head'):
+      del node.head
+  return tree
+
+class RuleHeadFlags:
+  '''
+  picklable rule_head_flags for map_rules
+  '''
+  def __init__(self, local=True):
+    self.local = local
+
+  def __call__(self, rule):
+    return rule_head_flags(rule, self.local)
+
+def rule_heads(fh, local=True, workers=1, chunksize=1000):
+  '''
+  yield the head flags of every rule in a rule file, in file order, in
+  worker processes if workers is not 1
+
+  >>> from StringIO import StringIO
+  >>> text = 'A(x0:B C("c")) -> x0 "c" ### headmarker={{{R(DH)}}}\\nB("b") -> "b" ### headmarker={{{R(H)}}}\\n'
+  >>> [list(flags) for flags in rule_heads(StringIO(text))]
+  [[2, 0, 1, 1], [1, 1]]
+  '''
+  return map_rules(RuleHeadFlags(local), fh, workers, chunksize)
+
 def head_annotate_tree(heads, target, relative=None):
   '''
   given a RHV head tree and a chiang tree that matches in form, set a boolean "head"
@@ -164,7 +881,7 @@ def head_annotate_tree_inner(heads, target, relative):
   #              if parent is not head, label all children not head
   #              if parent is not labeled, no labels
   if target.is_terminal() or target.is_preterminal():
-    if target.is_preterminal() and 'head' in target.__dict__:
+    if target.is_preterminal() and hasattr(target, 'head'):
       target.children[0].head=target.head
 #    print "Short cut for pre/terminal target "+str(target)
     return target
@@ -172,10 +889,10 @@ def head_annotate_tree_inner(heads, target, relative):
     raise Exception("Heads tree doesn't match target: "+str(heads)+" vs "+str(target))
   newchildren=[]
   for (label, node) in zip(heads.children, target.children):
-    if relative is None or relative == target or ('head' in target.__dict__ and target.head):
+    if relative is None or relative == target or (hasattr(target, 'head') and target.head):
       node.head = True if label.label == "H" else False
 #      print "Setting "+node.label+" to "+str(node.head)
-    elif ('head' in target.__dict__ and not target.head):
+    elif (hasattr(target, 'head') and not target.head):
 #      print "Setting "+node.label+" to False unilaterally"
       node.head = False
     newchildren.append(head_annotate_tree_inner(label, node, relative))
@@ -4,42 +4,174 @@
 # from https://gist.github.com/pib/240957
 # and http://probablyprogramming.com/2009/11/23/a-simple-lisp-parser-in-python
 # slight adapations by jon may
+# now a tokenizer and a stack of open lists, fed text a piece at a time:
+# >>> parser = sexp.Parser()
+# >>> for chunk in chunks:
+# ...     for form in parser.feed(chunk):
+# ...         handle(form)
+# >>> parser.close()
+# lists become lists, symbols 1-tuples, strings strings, 'x becomes
+# [('quote',), x] and atoms starting with a digit numbers
 
-from string import whitespace
- 
-atom_end = set('()"\'') | set(whitespace)
- 
-def parse(sexp):
-    stack, i, length = [[]], 0, len(sexp)
-    while i < length:
-        c = sexp[i]
- 
-#        print c, stack
-        reading = type(stack[-1])
-        if reading == list:
-            if   c == '(': stack.append([])
-            elif c == ')': 
-                stack[-2].append(stack.pop())
-                if stack[-1][0] == ('quote',): stack[-2].append(stack.pop())
-            elif c == '"': stack.append('')
-            elif c == "'": stack.append([('quote',)])
-            elif c in whitespace: pass
-            else: stack.append((c,))
-        elif reading == str:
-            if   c == '"': 
-                stack[-2].append(stack.pop())
-                if stack[-1][0] == ('quote',): stack[-2].append(stack.pop())
-            elif c == '\\': 
-                i += 1
-                stack[-1] += sexp[i]
-            else: stack[-1] += c
-        elif reading == tuple:
-            if c in atom_end:
-                atom = stack.pop()
-                if atom[0][0].isdigit(): stack[-1].append(eval(atom[0]))
-                else: stack[-1].append(atom)
-                if stack[-1][0] == ('quote',): stack[-2].append(stack.pop())
+import re
+
+QUOTE = ('quote',)
+
+# optional whitespace, then a string, a paren, a quote or an atom; a lone "
+# starts a string that is not finished
+tokenizer = re.compile(r'\s*("(?:[^"\\]|\\.)*"|[()\']|[^\s()"\']+|")', re.DOTALL)
+escape = re.compile(r'\\(.)', re.DOTALL)
+# the inside of a string up to its closing quote, or up to the end of the
+# text read so far, short of a backslash whose escaped character is still to
+# come
+string_body = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+
+def atom(token):
+    """A number if token starts with a digit and reads as one (int with a
+    0x or 0 prefix for hex or octal and an optional L suffix, or float),
+    otherwise a symbol.
+
+    >>> (atom('12'), atom('0x1fL'), atom('2.5'), atom('3d'))
+    (12, 31L, 2.5, ('3d',))
+    """
+    if token[0].isdigit():
+        try:
+            if token[-1] in 'lL':
+                return long(token, 0)
+            return int(token, 0)
+        except ValueError:
+            try:
+                return float(token)
+            except ValueError:
+                pass
+    return (token,)
+
+class Parser:
+    """Incremental s-expression parser.  feed() takes text in pieces of any
+    size and returns the top-level forms completed so far.  Only a token
+    left unfinished at the end of a piece is kept for the next one, and the
+    pieces of a long string are each scanned once for its closing quote, so
+    the work done is linear in the input however it is split.
+
+    >>> parser = Parser()
+    >>> parser.feed('(define x 1')
+    []
+    >>> parser.feed('0.5) "a \\\\"b\\\\"" \\'(c 0x1f)  ab')
+    [[('define',), ('x',), 10.5], 'a "b"', [('quote',), [('c',), 31]]]
+    >>> parser.feed('c ')
+    [('abc',)]
+    >>> [parser.feed(piece) for piece in ('"s', 't\\\\', '"r', '" ')]
+    [[], [], [], ['st"r']]
+    >>> parser.feed('(1 ')
+    []
+    >>> parser.close()
+    Traceback (most recent call last):
+    ...
+    Exception: incomplete s-expression at end of input
+    """
+    def __init__(self):
+        self.buffer = ''
+        # the open lists; a quote is a list [QUOTE] waiting for one form
+        self.stack = []
+        # the pieces of an unfinished string, when there is one, and whether
+        # the last of them ends in the backslash of an escape
+        self.string = None
+        self.escaped = False
+
+    def feed(self, text):
+        if self.string is not None:
+            if text == '':
+                return []
+            end = string_body.match(text, 1 if self.escaped else 0).end()
+            if end == len(text) or text[end] != '"':
+                self.string.append(text)
+                self.escaped = end < len(text)
+                return []
+            text = ''.join(self.string) + text
+            self.string = None
+        self.buffer += text
+        return self._parse(False)
+
+    def close(self):
+        """Finish the input, returning any last form."""
+        if self.string is not None:
+            raise Exception("incomplete s-expression at end of input")
+        forms = self._parse(True)
+        if len(self.stack) > 0 or self.buffer.strip() != '':
+            raise Exception("incomplete s-expression at end of input")
+        return forms
+
+    def _parse(self, final):
+        buffer = self.buffer
+        stack = self.stack
+        forms = []
+        self.buffer = ''
+        for match in tokenizer.finditer(buffer):
+            token = match.group(1)
+            c = token[0]
+            if c == '(':
+                stack.append([])
+                continue
+            if c == "'":
+                stack.append([QUOTE])
                 continue
-            else: stack[-1] = ((stack[-1][0] + c),)
-        i += 1
-    return stack.pop()
+            if c == ')':
+                if len(stack) == 0 or (len(stack[-1]) == 1 and stack[-1][0] is QUOTE):
+                    raise Exception("unexpected ) in s-expression")
+                form = stack.pop()
+            elif c == '"':
+                if len(token) == 1:
+                    if final:
+                        raise Exception("incomplete s-expression at end of input")
+                    # an unfinished string: keep it until its end is fed
+                    start = match.start(1)
+                    self.string = [buffer[start:]]
+                    self.escaped = string_body.match(buffer, start + 1).end() < len(buffer)
+                    break
+                form = token[1:-1]
+                if '\\' in form:
+                    form = escape.sub(r'\1', form)
+            elif not final and match.end() == len(buffer):
+                # the last atom may go on in the next piece
+                self.buffer = token
+                break
+            else:
+                form = atom(token)
+            # add the form to the open list, closing any quotes it completes
+            while len(stack) > 0:
+                parent = stack[-1]
+                parent.append(form)
+                if parent[0] is not QUOTE:
+                    break
+                stack.pop()
+                form = parent
+            else:
+                forms.append(form)
+        return forms
+
+def parse(sexp):
+    """The list of top-level forms in sexp.
+
+    >>> parse("(a (b 1 2.5) 'c \\"d\\" ()) e")
+    [[('a',), [('b',), 1, 2.5], [('quote',), ('c',)], 'd', []], ('e',)]
+    """
+    parser = Parser()
+    forms = parser.feed(sexp)
+    forms.extend(parser.close())
+    return forms
+
+def read(fh):
+    """Yield the top-level forms of a file or pipe as soon as each is
+    complete, reading a line at a time."""
+    parser = Parser()
+    for line in iter(fh.readline, ''):
+        for form in parser.feed(line):
+            yield form
+    for form in parser.close():
+        yield form
+
+
+if __name__ == '__main__':
+    print "Running doctest"
+    import doctest
+    doctest.testmod()
@@ -7,41 +7,94 @@
 
 import sgmllib, xml.sax.saxutils
 import re
+import instrument
 
 class TreeDeleted(Exception):
     pass
 
-class Node:
-    "Tree node"
+class Node(object):
+    """Tree node.  Fields live in __slots__ rather than a per-node dict; attrs
+    and head are the optional extras that TreeParser and sbmt set.
+
+    _start caches the position of the node's first leaf in the whole tree.
+    Within a tree either every node has it or none does: span() fills in
+    the whole tree on first use, insert_child and delete_child shift the
+    nodes after the edit, and joining trees clears the joined parts.
+
+    _words and _tags cache the leaf and preterminal labels of the whole tree
+    on its root, for words() and tags() to slice by span.  Inserting or
+    deleting a child clears them on the way up; relabelling a leaf in place
+    does not, so do that before calling words() or tags()."""
+    __slots__ = ('label', 'children', 'length', 'parent', 'order', 'attrs', 'head', '_start', '_words', '_tags')
+
     def __init__(self, label, children=None):
         self.label = label
-        if children is None:
-            self.children = []
-        else:
-            self.children = children
-        self.length = 0
-        for i in range(len(self.children)):
-            self.children[i].parent = self
-            self.children[i].order = i
-            self.length += self.children[i].length
-        if len(self.children) == 0:
-            self.length = 1
         self.parent = None
         self.order = 0
+        self._start = None
+        self._words = self._tags = None
+        if not children:
+            self.children = [] if children is None else children
+            self.length = 1
+            return
+        self.children = children
+        self.length = 0
+        for (i, child) in enumerate(children):
+            child.parent = self
+            child.order = i
+            self.length += child.length
+            if child._start is not None:
+                child._clear_starts()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in Node.__slots__ if hasattr(self, name) and name not in ('_start', '_words', '_tags'))
+
+    def __setstate__(self, state):
+        self._start = None
+        self._words = self._tags = None
+        for (name, value) in state.items():
+            setattr(self, name, value)
 
     def __str__(self):
         if len(self.children) != 0:
-            s = "(" + str(self.label)
-            for child in self.children:
-                s += " " + child.__str__()
-            s += ")"
-            return s
+            out = []
+            self.pieces(out)
+            return "".join(out)
         else:
             s = self.label
 #            s = s.replace("(", "-LRB-")
 #            s = s.replace(")", "-RRB-")
             return s
 
+    def pieces(self, out):
+        """Append the pieces of str(self) to the list out, without recursion,
+        so that many trees can be joined or written at once.  Each level keeps
+        an iterator over its children on a stack; leaves and preterminals are
+        written as they are met and other nodes are descended into."""
+        if len(self.children) == 0:
+            out.append(self.label)
+            return
+        out.append("(" + str(self.label))
+        stack = [iter(self.children)]
+        while len(stack) > 0:
+            for child in stack[-1]:
+                children = child.children
+                if len(children) == 0:
+                    out.append(" " + child.label)
+                    continue
+                label = child.label
+                if type(label) is not str:
+                    label = str(label)
+                if len(children) == 1 and len(children[0].children) == 0:
+                    out.append(" (" + label + " " + children[0].label + ")")
+                    continue
+                out.append(" (" + label)
+                stack.append(iter(children))
+                break
+            else:
+                out.append(")")
+                stack.pop()
+
     def is_terminal(self):
         return len(self.children) == 0
 
@@ -49,33 +102,82 @@ class Node:
         return len(self.children) == 1 and self.children[0].is_terminal()
 
     def descendant(self, addr):
-        if len(addr) == 0:
-            return self
-        else:
-            return self.children[addr[0]].descendant(addr[1:])
+        node = self
+        for i in addr:
+            node = node.children[i]
+        return node
     
     def _adjust_length(self, delta):
-        self.length += delta
-        if self.parent is not None:
-            self.parent._adjust_length(delta)
+        node = self
+        while node is not None:
+            node.length += delta
+            node._words = node._tags = None
+            node = node.parent
+
+    def _fill_starts(self):
+        "Set _start below this node, whose own _start is set"
+        instrument.count('tree.fill_starts')
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            i = node._start
+            for child in node.children:
+                child._start = i
+                i += child.length
+            stack.extend(node.children)
+
+    def _clear_starts(self):
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            node._start = None
+            stack.extend(node.children)
+
+    def _shift_after(self, i, delta):
+        "Move the spans of everything to the right of self.children[i]"
+        node = self
+        while node is not None:
+            for sister in node.children[i+1:]:
+                stack = [sister]
+                while len(stack) > 0:
+                    n = stack.pop()
+                    n._start += delta
+                    stack.extend(n.children)
+            i = node.order
+            node = node.parent
 
     def insert_child(self, i, child):
+        if child._start is not None:
+            child._clear_starts()
         child.parent = self
         self.children[i:i] = [child]
         for j in range(i,len(self.children)):
             self.children[j].order = j
         if len(self.children) > 1:
-            self._adjust_length(child.length)
+            delta = child.length
         else:
-            self._adjust_length(child.length-1) # because self.label changes into nonterminal
+            delta = child.length-1 # because self.label changes into nonterminal
+        self._adjust_length(delta)
+        if self._start is not None:
+            if child.order > 0:
+                sister = self.children[child.order-1]
+                child._start = sister._start + sister.length
+            else:
+                child._start = self._start
+            child._fill_starts()
+            self._shift_after(child.order, delta)
 
     def append_child(self, child):
         self.insert_child(len(self.children), child)
 
     def delete_child(self, i):
-        self.children[i].parent = None
-        self.children[i].order = 0
-        self._adjust_length(-self.children[i].length)
+        child = self.children[i]
+        if self._start is not None:
+            self._shift_after(i, -child.length)
+            child._clear_starts()
+        child.parent = None
+        child.order = 0
+        self._adjust_length(-child.length)
         self.children[i:i+1] = []
         for j in range(i,len(self.children)):
             self.children[j].order = j
@@ -118,19 +220,75 @@ class Node:
         else:
             return [self]
 
+    def _yields(self):
+        """Return the root, with _words and _tags filled in, or None if the
+        tree's lengths don't match its leaves (as when a phrase has lost all
+        its children)"""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if root._words is None:
+            words = []
+            tags = []
+            stack = [root]
+            while len(stack) > 0:
+                node = stack.pop()
+                if len(node.children) == 0:
+                    words.append(node.label)
+                    tags.append(node.label)
+                elif len(node.children) == 1 and len(node.children[0].children) == 0:
+                    words.append(node.children[0].label)
+                    tags.append(node.label)
+                else:
+                    stack.extend(reversed(node.children))
+            if len(words) != root.length:
+                return None
+            root._words = words
+            root._tags = tags
+        return root
+
     def tags(self):
-        return [n.label for n in self.pret_frontier()]
+        """labels of the preterminal frontier (leaves without a preterminal
+        stand for themselves), sliced from a list cached on the root
+
+        >>> t = str_to_tree("(S (NP (DT the) cow) (VP (VBZ moos)))")
+        >>> (t.tags(), t.children[0].tags(), t.children[1].children[0].tags())
+        (['DT', 'cow', 'VBZ'], ['DT', 'cow'], ['VBZ'])
+        """
+        if self.is_terminal() or self.is_preterminal():
+            return [self.label]
+        root = self._yields()
+        if root is None:
+            return [n.label for n in self.pret_frontier()]
+        (i, j) = self.span()
+        return root._tags[i:j]
 
     def words(self):
-        return [n.label for n in self.frontier()]
+        """labels of the leaves, sliced from a list cached on the root
+
+        >>> t = str_to_tree("(S (NP (DT the) cow) (VP (VBZ moos)))")
+        >>> t.children[1].append_child(Node("loudly"))
+        >>> (t.words(), t.children[1].words())
+        (['the', 'cow', 'moos', 'loudly'], ['moos', 'loudly'])
+        """
+        if self.is_terminal():
+            return [self.label]
+        root = self._yields()
+        if root is None:
+            return [n.label for n in self.frontier()]
+        (i, j) = self.span()
+        return root._words[i:j]
 
     def span(self):
-        if self.parent is None:
-            return (0,self.length)
-        (i, j) = self.parent.span()
-        for sister in self.parent.children[:self.order]:
-            i += sister.length
-        return (i, i+self.length)
+        """span of the node's leaves in the whole tree.  O(1) once the tree's
+        spans are cached; the first call caches them all."""
+        if self._start is None:
+            root = self
+            while root.parent is not None:
+                root = root.parent
+            root._start = 0
+            root._fill_starts()
+        return (self._start, self._start+self.length)
 
     def is_dominated_by(self, node):
         return self is node or (self.parent != None and self.parent.is_dominated_by(node))
@@ -188,9 +346,35 @@ class Node:
         return result
 
     def fill(self, i, j):
-        """input: a span
-        output: minimum set of nodes that exactly covers them"""
-        return Node.fill_span(self.frontier(), i, j)
+        """input: a span (relative to this node)
+        output: minimum set of nodes that exactly covers them
+
+        Walks down from this node using the cached spans rather than
+        climbing up from the frontier.
+
+        >>> t = str_to_tree("(S (NP (DT the) (NN cow)) (VP (VBZ eats) (NP grass)))")
+        >>> [str(n) for n in t.fill(1, 4)]
+        ['(NN cow)', '(VP (VBZ eats) (NP grass))']
+        >>> t.children[1].insert_child(0, str_to_tree("(RB often)"))
+        >>> [(n.label, n.span()) for n in t.fill(0, 5)]
+        [('S', (0, 5))]
+        >>> [(n.label, n.span()) for n in t.children[1].fill(1, 3)]
+        [('VBZ', (3, 4)), ('NP', (4, 5))]
+        """
+        result = []
+        base = self.span()[0]
+        i += base
+        j += base
+        while i < j:
+            node = self
+            while node._start != i or node._start+node.length > j:
+                for child in node.children:
+                    if child._start+child.length > i:
+                        break
+                node = child
+            result.append(node)
+            i += node.length
+        return result
 
     def span_helper(self, i, s):
         # don't include terminals
@@ -202,45 +386,94 @@ class Node:
             i += child.length
 
     def spans(self):
-        """return a hash which maps from spans to lists of labels"""
+        """return a hash which maps from spans (relative to this node) to
+        lists of labels"""
         s = {}
-        self.span_helper(0, s)
+        base = self.span()[0]
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            # don't include terminals
+            if len(node.children) == 0:
+                continue
+            s.setdefault((node._start-base, node._start-base+node.length), []).append(node.label)
+            stack.extend(reversed(node.children))
         return s
 
 def scan_tree(tokens, pos):
-    try:
-        if tokens[pos] == "(":
-            if tokens[pos+1] == "(":
+    """Read the tree that starts at tokens[pos].  Returns (tree, position
+    after it), or (None, pos) if no complete tree starts there.  The nodes
+    are built top-down with their parent, order and length set as they are
+    read, and an explicit stack is used so there is no limit on depth.
+    Phrase labels are interned."""
+    start = pos
+    n = len(tokens)
+    if pos >= n or tokens[pos] == ")":
+        return (None, pos)
+    if tokens[pos] != "(":
+#        label = label.replace("-LRB-", "(")
+#        label = label.replace("-RRB-", ")")
+        return (Node(tokens[pos]), pos+1)
+    stack = []
+    top = None
+    while pos < n:
+        token = tokens[pos]
+        if token == ")":
+            pos += 1
+            node = stack.pop()
+            if node.length == 0:
+                node.length = 1
+            if len(stack) == 0:
+                return (node, pos)
+            top = stack[-1]
+            top.length += node.length
+        elif token == "(":
+            if pos+1 < n and tokens[pos+1] == "(":
                 label = ""
                 pos += 1
-            else:
+            elif pos+1 < n:
                 label = tokens[pos+1]
                 pos += 2
-            children = []
-            (child, pos) = scan_tree(tokens, pos)
-            while child != None:
-                children.append(child)
-                (child, pos) = scan_tree(tokens, pos)
-            if tokens[pos] == ")":
-                return (Node(label, children), pos+1)
             else:
-                return (None, pos)
-        elif tokens[pos] == ")":
-            return (None, pos)
+                break
+            if type(label) is str:
+                # share one copy of each label; intern only takes byte
+                # strings, and words are too many and too varied to be worth it
+                label = intern(label)
+            node = Node(label)
+            # lengths are summed from the children when the node is closed
+            node.length = 0
+            if top is not None:
+                node.parent = top
+                node.order = len(top.children)
+                top.children.append(node)
+            stack.append(node)
+            top = node
         else:
-            label = tokens[pos]
-#            label = label.replace("-LRB-", "(")
-#            label = label.replace("-RRB-", ")")
-            return (Node(label,[]), pos+1)
-    except IndexError:
-        return (None, pos)
+            pos += 1
+            node = Node(token)
+            node.parent = top
+            node.order = len(top.children)
+            top.children.append(node)
+            top.length += 1
+    return (None, start)
 
 tokenizer = re.compile(r"\(|\)|[^()\s]+")
 
 def str_to_tree(s):
+    """Parse a bracketed tree.  Returns None unless s holds exactly one tree.
+
+    >>> print str_to_tree("(S (NP (DT the) (NN cow)) (VP moos))")
+    (S (NP (DT the) (NN cow)) (VP moos))
+    >>> t = str_to_tree("(X " * 5000 + "x" + ")" * 5000)
+    >>> leaf = t.descendant([0] * 5000)
+    >>> (t.length, leaf.label, leaf.is_terminal(), leaf.parent.label)
+    (1, 'x', True, 'X')
+    """
     tokens = tokenizer.findall(s)
     (tree, n) = scan_tree(tokens, 0)
     if n != len(tokens):
+        instrument.count('tree.str_to_tree.failed')
         return None
     return tree
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# streaming access to treebank files
+# trees are found by bracket balance, so one tree may span many lines and many
+# trees may share a line; only the tree currently being read is held in memory
+# usage:
+# >>> import treebank
+# >>> with open('wsj.mrg') as f:
+# ...     for (index, offset, tree) in treebank.read_pstrees(f):
+# ...         print index, offset, tree.word_yield()
+# >>> with open('wsj.mrg') as fin, open('wsj.one', 'w') as fout:
+# ...     treebank.write_trees((t for (i, o, t) in treebank.read_pstrees(fin)), fout)
+
+import re
+import pstree
+import tree as chiangtree
+
+_bracket = re.compile(r"[()]")
+
+def read_tree_texts(fh, bufsize=1 << 20):
+  '''Yield (index, offset, text) for every top-level bracketed tree in the
+  file handle.  index counts trees from 0 and offset is the position of the
+  tree's opening bracket in the file (a byte offset for files opened in binary
+  or python 2 text mode).  Text outside of the trees is skipped.
+
+  >>> from StringIO import StringIO
+  >>> data = "(ROOT (S (NP (NNP Ms.)\\n  (NNP Haag))\\n  (VP (VBZ plays))))\\n( (NN x))"
+  >>> for item in read_tree_texts(StringIO(data), bufsize=7):
+  ...   print repr(item)
+  (0, 0, '(ROOT (S (NP (NNP Ms.)\\n  (NNP Haag))\\n  (VP (VBZ plays))))')
+  (1, 58, '( (NN x))')
+  '''
+  index = 0
+  offset = 0
+  depth = 0
+  start = 0
+  pieces = []
+  while True:
+    chunk = fh.read(bufsize)
+    if not chunk:
+      break
+    pos = 0
+    for match in _bracket.finditer(chunk):
+      if match.group() == '(':
+        if depth == 0:
+          start = offset + match.start()
+          pos = match.start()
+        depth += 1
+      elif depth > 0:
+        depth -= 1
+        if depth == 0:
+          pieces.append(chunk[pos:match.end()])
+          yield (index, start, ''.join(pieces))
+          index += 1
+          pieces = []
+    if depth > 0:
+      pieces.append(chunk[pos:])
+    offset += len(chunk)
+  if depth > 0:
+    raise Exception("File ended inside tree %d starting at offset %d" % (index, start))
+
+def read_pstrees(fh, bufsize=1 << 20, **kwargs):
+  '''Yield (index, offset, PSTree) for every tree in the file handle.  Extra
+  keyword arguments are passed to pstree.tree_from_text.
+
+  >>> from StringIO import StringIO
+  >>> data = "(ROOT (NP (NNP Newspaper)))\\n(ROOT\\n (NP (DT the)\\n     (NN cow)))\\n"
+  >>> for (index, offset, tree) in read_pstrees(StringIO(data)):
+  ...   print index, offset, tree
+  0 0 (ROOT (NP (NNP Newspaper)))
+  1 28 (ROOT (NP (DT the) (NN cow)))
+  '''
+  for (index, offset, text) in read_tree_texts(fh, bufsize):
+    yield (index, offset, pstree.tree_from_text(text, **kwargs))
+
+def read_nodes(fh, bufsize=1 << 20):
+  '''Yield (index, offset, tree.Node) for every tree in the file handle.
+
+  >>> from StringIO import StringIO
+  >>> for (index, offset, tree) in read_nodes(StringIO("(S (NP cows)\\n (VP moo))")):
+  ...   print index, offset, tree
+  0 0 (S (NP cows) (VP moo))
+  '''
+  for (index, offset, text) in read_tree_texts(fh, bufsize):
+    node = chiangtree.str_to_tree(text)
+    if node is None:
+      raise Exception("Could not parse tree %d at offset %d\n%s" % (index, offset, text))
+    yield (index, offset, node)
+
+def write_trees(trees, fh, bufsize=1 << 16):
+  '''Write each PSTree or tree.Node on a line of its own, exactly as str()
+  would give it, building the text in a list and writing it in batches of
+  about bufsize pieces.  Returns the number of trees written.
+
+  >>> from StringIO import StringIO
+  >>> out = StringIO()
+  >>> write_trees([pstree.tree_from_text("(ROOT (NP (NN cow)))"), chiangtree.str_to_tree("(S (NP cows) (VP moo))")], out, bufsize=4)
+  2
+  >>> print out.getvalue(),
+  (ROOT (NP (NN cow)))
+  (S (NP cows) (VP moo))
+  '''
+  out = []
+  count = 0
+  for tree in trees:
+    tree.pieces(out)
+    out.append('\n')
+    count += 1
+    if len(out) >= bufsize:
+      fh.write(''.join(out))
+      out = []
+  if len(out) > 0:
+    fh.write(''.join(out))
+  return count
+
+
+if __name__ == '__main__':
+  print "Running doctest"
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# a whole treebank stored as numpy columns rather than node objects
+# usage:
+# >>> import treebank, treecorpus
+# >>> with open('wsj.mrg') as f:
+# ...     corpus = treecorpus.TreeCorpus.from_pstrees(t for (i, o, t) in treebank.read_pstrees(f))
+# >>> corpus.label_counts()['NP']
+# >>> print corpus.pstree(17)
+# >>> corpus.save('wsj.tc')
+# >>> corpus = treecorpus.TreeCorpus.load('wsj.tc')   # mmapped, nothing parsed
+
+from array import array
+import numpy
+import binfile
+import jmutil
+import pstree
+import head_finder
+import tree as chiangtree
+
+NONE = -1
+
+# version 2: the binfile layout, with the vocab's strings as a uint8 array
+# version 3: a flag per string for those saved from unicode as utf-8
+MAGIC = 'TREECORPUS 3\n'
+COLUMNS = ('label', 'word', 'parent', 'first_child', 'next_sibling', 'span_start', 'span_end', 'tree_offsets')
+
+class TreeCorpus:
+  '''A corpus of trees as parallel columns, one row per node.
+
+  Rows are numbered across the whole corpus, with the nodes of each tree
+  stored contiguously in pre-order; tree i owns rows
+  tree_offsets[i]:tree_offsets[i+1].  The columns are
+    label, word      ids in vocab, or NONE
+    parent           row of the parent, or NONE at a root
+    first_child      row of the first child, or NONE
+    next_sibling     row of the next sister, or NONE
+    span_start/end   word span of the node within its tree
+  Labels and words share one jmutil.Vocab.
+
+  PSTree nodes map to one row each.  For tree.Node, a terminal becomes a row
+  with a word and no label, and a preterminal (a node whose only child is a
+  terminal) is folded into a single row with both, so that both kinds of tree
+  look alike in the columns; the conversions back are lossless.
+
+  >>> trees = [pstree.tree_from_text("(ROOT (NP (DT the) (NN cow)) (VP (VBZ moos)))"),
+  ...          pstree.tree_from_text("(ROOT (NP (NNS cows)))")]
+  >>> corpus = TreeCorpus.from_pstrees(trees)
+  >>> (len(corpus), corpus.num_nodes(), list(corpus.tree_sizes()))
+  (2, 9, [6, 3])
+  >>> print corpus.pstree(0)
+  (ROOT (NP (DT the) (NN cow)) (VP (VBZ moos)))
+  >>> sorted(corpus.label_counts().items())
+  [('DT', 1), ('NN', 1), ('NNS', 1), ('NP', 2), ('ROOT', 2), ('VBZ', 1), ('VP', 1)]
+  >>> list(corpus.depths()[:7])
+  [0, 1, 2, 2, 1, 2, 0]
+  >>> corpus = TreeCorpus.from_nodes([chiangtree.str_to_tree("(S (NP (DT the) cow) (VP moos))")])
+  >>> print corpus.node(0)
+  (S (NP (DT the) cow) (VP moos))
+  >>> print corpus.pstree(0)
+  (S (NP (DT the) (label_not_set cow)) (VP moos))
+
+  save writes a binary file that load maps back into memory without parsing
+  or copying:
+  >>> import os, tempfile
+  >>> (fd, filename) = tempfile.mkstemp()
+  >>> TreeCorpus.from_pstrees(trees).save(filename)
+  >>> corpus = TreeCorpus.load(filename)
+  >>> print corpus.pstree(1)
+  (ROOT (NP (NNS cows)))
+  >>> (corpus.vocab.get('VP'), 'moos' in corpus.vocab, corpus.vocab.get('moo'))
+  (6, True, -1)
+  >>> TreeCorpus.from_pstrees([pstree.tree_from_text(u"(NP\\u00e9 (NN caf\\u00e9))")]).save(filename)
+  >>> corpus = TreeCorpus.load(filename)
+  >>> (corpus.pstree(0).label, corpus.pstree(0).word_yield(), corpus.vocab.get(u'NP\\u00e9'))
+  (u'NP\\xe9', u'caf\\xe9', 0)
+  >>> del corpus; os.close(fd); os.remove(filename)
+  '''
+  def __init__(self, label, word, parent, first_child, next_sibling, span_start, span_end, tree_offsets, vocab):
+    self.label = label
+    self.word = word
+    self.parent = parent
+    self.first_child = first_child
+    self.next_sibling = next_sibling
+    self.span_start = span_start
+    self.span_end = span_end
+    self.tree_offsets = tree_offsets
+    self.vocab = vocab
+
+  def __len__(self):
+    return len(self.tree_offsets) - 1
+
+  def save(self, filename):
+    '''Write the corpus to a binfile: the columns, and the vocab's strings
+    back to back with their offsets.  unicode strings are stored as utf-8
+    and flagged, so that load gives them back as unicode.'''
+    encoded = numpy.array([isinstance(s, unicode) for s in self.vocab.strings], dtype=numpy.uint8)
+    strings = [s.encode('utf-8') if isinstance(s, unicode) else s for s in self.vocab.strings]
+    string_offsets = numpy.zeros(len(strings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(s) for s in strings], out=string_offsets[1:])
+    arrays = [(name, getattr(self, name)) for name in COLUMNS]
+    arrays.append(('string_offsets', string_offsets))
+    arrays.append(('string_encoded', encoded))
+    arrays.append(('strings', numpy.frombuffer(''.join(strings), dtype=numpy.uint8)))
+    binfile.save(filename, MAGIC, arrays)
+
+  @staticmethod
+  def load(filename):
+    '''Map a file written by save into memory.  The columns are read-only
+    numpy views of the file, so loading costs the same however large the
+    corpus is; vocab strings are decoded only when they are looked up.'''
+    (arrays, meta) = binfile.load(filename, MAGIC)
+    vocab = _MappedVocab(_PackedStrings(arrays['strings'], arrays['string_offsets'], arrays['string_encoded']))
+    return TreeCorpus(*([arrays[name] for name in COLUMNS] + [vocab]))
+
+  def num_nodes(self):
+    return len(self.label)
+
+  def tree_rows(self, i):
+    '''Return the (start, end) rows of tree i.'''
+    return (int(self.tree_offsets[i]), int(self.tree_offsets[i + 1]))
+
+  def tree_of(self, rows):
+    '''Map node rows to the index of the tree they belong to.'''
+    return numpy.searchsorted(self.tree_offsets, rows, 'right') - 1
+
+  @staticmethod
+  def from_pstrees(trees, vocab=None):
+    '''Build a corpus from an iterable of PSTrees, keeping their spans.'''
+    builder = _Builder(vocab)
+    for root in trees:
+      builder.start_tree()
+      for node in root:
+        word = NONE if node.word is None else builder.vocab.id(node.word)
+        builder.add(node, builder.vocab.id(node.label), word, node.span[0], node.span[1])
+    return builder.corpus()
+
+  @staticmethod
+  def from_nodes(trees, vocab=None):
+    '''Build a corpus from an iterable of tree.Node trees.'''
+    builder = _Builder(vocab)
+    for root in trees:
+      builder.start_tree()
+      pos = 0
+      stack = [root]
+      while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, tuple):
+          # a closing marker, pushed once the node's leaves are known
+          builder.span_end[node[1]] = pos
+          continue
+        if node.is_terminal():
+          builder.add(node, NONE, builder.vocab.id(node.label), pos, pos + 1)
+          pos += 1
+        elif node.is_preterminal():
+          builder.add(node, builder.vocab.id(node.label), builder.vocab.id(node.children[0].label), pos, pos + 1)
+          pos += 1
+        else:
+          builder.add(node, builder.vocab.id(node.label), NONE, pos, pos)
+          stack.append((node, len(builder.label) - 1))
+          stack.extend(reversed(node.children))
+    return builder.corpus()
+
+  def _label(self, row):
+    i = self.label[row]
+    return pstree.DEFAULT_LABEL if i == NONE else self.vocab.strings[i]
+
+  def _word(self, row):
+    i = self.word[row]
+    return None if i == NONE else self.vocab.strings[i]
+
+  def pstree(self, i):
+    '''Rebuild tree i as a PSTree.'''
+    (start, end) = self.tree_rows(i)
+    nodes = []
+    parents = self.parent[start:end].tolist()
+    for (row, parent) in zip(xrange(start, end), parents):
+      node = pstree.PSTree(self._word(row), self._label(row), (int(self.span_start[row]), int(self.span_end[row])))
+      if parent != NONE:
+        node.parent = nodes[parent - start]
+        node.parent.subtrees.append(node)
+      nodes.append(node)
+    return nodes[0]
+
+  def pstrees(self):
+    for i in xrange(len(self)):
+      yield self.pstree(i)
+
+  def node(self, i):
+    '''Rebuild tree i as a tree.Node.'''
+    (start, end) = self.tree_rows(i)
+    nodes = []
+    parents = self.parent[start:end].tolist()
+    for (row, parent) in zip(xrange(start, end), parents):
+      label = self.label[row]
+      word = self._word(row)
+      if label == NONE:
+        node = chiangtree.Node(word)
+      else:
+        node = chiangtree.Node(self.vocab.strings[label])
+        if word is not None:
+          node.append_child(chiangtree.Node(word))
+      if parent != NONE:
+        owner = nodes[parent - start]
+        node.parent = owner
+        node.order = len(owner.children)
+        owner.children.append(node)
+      nodes.append(node)
+    # lengths count leaves, so they are the span widths
+    for (node, length) in zip(nodes, (self.span_end[start:end] - self.span_start[start:end]).tolist()):
+      node.length = length
+    return nodes[0]
+
+  def nodes(self):
+    for i in xrange(len(self)):
+      yield self.node(i)
+
+  # corpus-wide analytics, computed over the columns
+
+  def tree_sizes(self):
+    '''Number of rows in each tree.'''
+    return numpy.diff(self.tree_offsets)
+
+  def span_lengths(self):
+    return self.span_end - self.span_start
+
+  def label_counts(self):
+    '''Return a dict from label to the number of rows carrying it.'''
+    labels = self.label[self.label != NONE]
+    counts = numpy.bincount(labels, minlength=len(self.vocab))
+    return dict((self.vocab.strings[i], int(counts[i])) for i in numpy.flatnonzero(counts))
+
+  def depths(self):
+    '''Depth of every row below its root, found by following all parent
+    links in step.'''
+    depth = numpy.zeros(len(self.parent), dtype=numpy.int32)
+    cur = self.parent.copy()
+    live = cur != NONE
+    while live.any():
+      depth += live
+      cur[live] = self.parent[cur[live]]
+      live = cur != NONE
+    return depth
+
+  def find_heads(self, rules=None):
+    '''Return the row of the head word of every row, chosen as
+    head_finder.find_heads would with the same compiled rules
+    (head_finder.collins_rules by default); word rows head themselves and a
+    phrase with no children gets NONE.  Heads are resolved a level at a time
+    from the bottom up: the children at one depth are given their rule group
+    from a label-by-label priority matrix and sorted by parent, group and
+    position, and the first child of each parent wins.
+
+    >>> corpus = TreeCorpus.from_pstrees([pstree.tree_from_text("(ROOT (S (NP (NP (NNP John) (POS 's)) (NN dog)) (VP (VBD barked))))")])
+    >>> heads = corpus.find_heads()
+    >>> [corpus.vocab.strings[corpus.word[heads[row]]] for row in xrange(corpus.num_nodes()) if corpus.word[row] == NONE]
+    ['barked', 'barked', 'dog', "'s", 'barked']
+    '''
+    if rules is None:
+      rules = head_finder.collins_rules
+    (rule_of, priority, last, pos_last) = _head_tables(rules, self.vocab)
+    pos = self.vocab.get('POS')
+    unlabelled = priority.shape[1] - 1
+    rows = numpy.arange(len(self.label), dtype=numpy.int32)
+    label = numpy.where(self.label == NONE, unlabelled, self.label)
+    rule = rule_of[label]
+    head = numpy.where(self.word != NONE, rows, NONE).astype(numpy.int32)
+    if len(rows) == 0:
+      return head
+    depth = self.depths()
+    order = numpy.argsort(depth, kind='mergesort')
+    bounds = numpy.searchsorted(depth[order], numpy.arange(depth.max() + 2))
+    for d in xrange(depth.max(), 0, -1):
+      children = order[bounds[d]:bounds[d + 1]]
+      parents = self.parent[children]
+      r = rule[parents]
+      child_heads = head[children]
+      tag = numpy.where(child_heads != NONE, label[child_heads], unlabelled)
+      group = numpy.minimum(priority[r, label[children]], priority[r, tag])
+      tiebreak = numpy.where(last[r, group], -children, children)
+      if pos != NONE:
+        group[pos_last[r] & (self.next_sibling[children] == NONE) & (tag == pos)] = -1
+      ranked = numpy.lexsort((tiebreak, group, parents))
+      ranked_parents = parents[ranked]
+      first = numpy.ones(len(ranked), dtype=bool)
+      first[1:] = ranked_parents[1:] != ranked_parents[:-1]
+      head[ranked_parents[first]] = child_heads[ranked[first]]
+    return head
+
+  def rows_with_label(self, label):
+    '''Rows whose label is the given string.'''
+    i = self.vocab.get(label)
+    return numpy.flatnonzero(self.label == i) if i != NONE else numpy.zeros(0, dtype=numpy.int64)
+
+class _Builder:
+  '''Accumulates rows in compact arrays while a corpus is being read.'''
+  def __init__(self, vocab):
+    self.vocab = jmutil.Vocab() if vocab is None else vocab
+    self.label = array('i')
+    self.word = array('i')
+    self.parent = array('i')
+    self.first_child = array('i')
+    self.next_sibling = array('i')
+    self.span_start = array('i')
+    self.span_end = array('i')
+    self.tree_offsets = array('l', [0])
+    self.rows = {}
+    self.last_child = {}
+
+  def start_tree(self):
+    self.tree_offsets.append(len(self.label))
+    self.rows = {}
+    self.last_child = {}
+
+  def add(self, node, label, word, start, end):
+    '''Add a row for node; its parent must already have been added.'''
+    row = len(self.label)
+    self.rows[id(node)] = row
+    self.label.append(label)
+    self.word.append(word)
+    self.first_child.append(NONE)
+    self.next_sibling.append(NONE)
+    self.span_start.append(start)
+    self.span_end.append(end)
+    parent = NONE if node.parent is None else self.rows.get(id(node.parent), NONE)
+    self.parent.append(parent)
+    if parent != NONE:
+      if parent in self.last_child:
+        self.next_sibling[self.last_child[parent]] = row
+      else:
+        self.first_child[parent] = row
+      self.last_child[parent] = row
+
+  def corpus(self):
+    offsets = self.tree_offsets[1:]
+    offsets.append(len(self.label))
+    column = lambda a: numpy.frombuffer(a, dtype=numpy.int32) if len(a) > 0 else numpy.zeros(0, dtype=numpy.int32)
+    return TreeCorpus(column(self.label), column(self.word), column(self.parent),
+                      column(self.first_child), column(self.next_sibling),
+                      column(self.span_start), column(self.span_end),
+                      numpy.array(offsets, dtype=numpy.int64), self.vocab)
+
+def _head_tables(rules, vocab):
+  '''Lay compiled head_finder rules out as arrays over vocab ids, with one
+  extra column standing for NONE and one extra rule for labels without one
+  (whose heads come from their last child):
+    rule_of[label]          the rule for a label
+    priority[rule, label]   the rule group the label falls in, with every
+                            label that matches no group in the last group
+    last[rule, group]       whether the group takes its rightmost match
+    pos_last[rule]          whether a POS-headed last child is taken first'''
+  names = sorted(rules)
+  groups = max([len(rules[name].last) for name in names] + [0])
+  labels = len(vocab) + 1
+  rule_of = numpy.zeros(labels, dtype=numpy.int32) + len(names)
+  priority = numpy.zeros((len(names) + 1, labels), dtype=numpy.int16) + groups
+  last = numpy.zeros((len(names) + 1, groups + 1), dtype=bool)
+  pos_last = numpy.zeros(len(names) + 1, dtype=bool)
+  for (r, name) in enumerate(names):
+    rule = rules[name]
+    i = vocab.get(name)
+    if i != NONE:
+      rule_of[i] = r
+    for (label, group) in rule.priority.items():
+      i = vocab.get(label)
+      if i != NONE:
+        priority[r, i] = group
+    if rule.wildcard is not None:
+      priority[r] = numpy.minimum(priority[r], rule.wildcard)
+    last[r, :len(rule.last)] = rule.last
+    last[r, groups] = rule.default_last
+    pos_last[r] = rule.pos_last
+  last[len(names), groups] = True
+  return (rule_of, priority, last, pos_last)
+
+class _PackedStrings:
+  '''Read-only list of the strings stored back to back in an array of
+  bytes, each sliced out and interned the first time it is asked for.
+  Strings flagged in encoded are decoded from utf-8 instead.'''
+  def __init__(self, data, offsets, encoded):
+    self.data = data
+    self.offsets = offsets
+    self.encoded = encoded
+    self.cache = [None] * (len(offsets) - 1)
+
+  def __len__(self):
+    return len(self.cache)
+
+  def __getitem__(self, i):
+    s = self.cache[i]
+    if s is None:
+      if i < 0:
+        i += len(self.cache)
+      s = self.data[int(self.offsets[i]):int(self.offsets[i + 1])].tostring()
+      s = s.decode('utf-8') if self.encoded[i] else intern(s)
+      self.cache[i] = s
+    return s
+
+  def __iter__(self):
+    for i in xrange(len(self.cache)):
+      yield self[i]
+
+class _MappedVocab(jmutil.Vocab):
+  '''jmutil.Vocab over _PackedStrings; the string-to-id dict is only built
+  when a string is looked up, and adding a string copies the strings into an
+  ordinary list.'''
+  def __init__(self, strings):
+    self.strings = strings
+
+  def __getattr__(self, name):
+    if name != 'ids':
+      raise AttributeError(name)
+    self.ids = dict((s, i) for (i, s) in enumerate(self.strings))
+    return self.ids
+
+  def id(self, string):
+    if string not in self.ids and isinstance(self.strings, _PackedStrings):
+      self.strings = list(self.strings)
+    return jmutil.Vocab.id(self, string)
+
+
+if __name__ == '__main__':
+  print "Running doctest"
+  import doctest
+  doctest.testmod()